@@ -8,6 +8,7 @@
 #include <LiquidCrystal_I2C.h>
 #include <WiFi.h>
 #include <HTTPClient.h>
+#include <time.h>
 
 // =================================================================
 //  CONFIGURACIÓN WiFi - MODIFICAR ESTOS VALORES
@@ -19,6 +20,9 @@ const char* SERVER_URL = "http://192.168.78.103:5000/api/traffic";  // IP de tu
 // Intervalo de envío de datos (ms)
 #define SEND_INTERVAL 5000
 
+// Espera adicional pedida por el servidor cuando está saturado (HTTP 429)
+unsigned long esperaExtraEnvio = 0;
+
 // -- Definiciones de Pines --
 #define LR1 5   // Semáforo 1 - Rojo
 #define LY1 4   // Semáforo 1 - Amarillo
@@ -62,6 +66,23 @@ int SP_PEATONAL = 15000;           // Tiempo cruce peatonal
 // Contador de activaciones (para enviar al servidor)
 int contadorPeatonalActivado = 0;
 
+// Número de secuencia de cada muestra (el servidor descarta reintentos duplicados)
+unsigned long numeroSecuencia = 0;
+
+// Identificador de este arranque: la secuencia vuelve a 1 tras cada reinicio
+// y el servidor usa el cambio de boot_id para reiniciar su deduplicación
+uint32_t idArranque = 0;
+
+// Muestra sin confirmar (timeout / error de red): se reenvía tal cual, con
+// el mismo seq y device_ts, para que el servidor la deduplique o la ubique
+// en su momento real y reenvíe el comando que se pudo perder
+String muestraPendiente = "";
+int reintentosPendiente = 0;
+#define MAX_REINTENTOS_MUESTRA 3
+
+// Epoch mínimo para considerar que el reloj ya se sincronizó por NTP
+#define EPOCH_VALIDO 1700000000UL
+
 // -- Pantalla LCD --
 LiquidCrystal_I2C lcd(0x27, 20, 4);
 
@@ -155,6 +176,8 @@ void conectarWiFi() {
   if (WiFi.status() == WL_CONNECTED) {
     wifiConnected = true;
     Serial.println("\n¡WiFi Conectado!");
+    // Hora real (UTC) para el "device_ts" de cada muestra
+    configTime(0, 0, "pool.ntp.org");
     Serial.print("IP: ");
     Serial.println(WiFi.localIP());
     
@@ -206,18 +229,77 @@ String obtenerNombreFase() {
   }
 }
 
+// POST de una muestra. Devuelve true si el servidor respondió (cualquier código HTTP)
+bool postearMuestra(String json) {
+  HTTPClient http;
+  http.begin(SERVER_URL);
+  http.addHeader("Content-Type", "application/json");
+  
+  Serial.print("Enviando: ");
+  Serial.println(json);
+  
+  int httpCode = http.POST(json);
+  
+  if (httpCode > 0) {
+    String response = http.getString();
+    Serial.print("Respuesta servidor (");
+    Serial.print(httpCode);
+    Serial.print("): ");
+    Serial.println(response);
+    
+    // Backpressure: respetar el "retry_after" del servidor antes del próximo envío
+    esperaExtraEnvio = 0;
+    if (httpCode == 429) {
+      int idx = response.indexOf("\"retry_after\":");
+      if (idx != -1) {
+        esperaExtraEnvio = response.substring(idx + 14).toInt() * 1000UL;
+      }
+      Serial.print("Servidor saturado, reintento en ");
+      Serial.print(esperaExtraEnvio / 1000);
+      Serial.println("s extra");
+    }
+    
+    // Procesar comandos del servidor (se entregan aunque la muestra se descarte)
+    procesarComandoServidor(response);
+  } else {
+    Serial.print("Error HTTP: ");
+    Serial.println(http.errorToString(httpCode));
+  }
+  
+  http.end();
+  return httpCode > 0;
+}
+
 void enviarDatosServidor() {
   if (!wifiConnected || WiFi.status() != WL_CONNECTED) {
     Serial.println("Sin WiFi - datos no enviados");
     return;
   }
   
-  HTTPClient http;
-  http.begin(SERVER_URL);
-  http.addHeader("Content-Type", "application/json");
+  // Primero la muestra que quedó sin confirmar (mismo seq: el servidor la deduplica)
+  if (muestraPendiente.length() > 0) {
+    Serial.println("Reintentando muestra sin confirmar");
+    if (postearMuestra(muestraPendiente)) {
+      muestraPendiente = "";
+      reintentosPendiente = 0;
+    } else if (++reintentosPendiente >= MAX_REINTENTOS_MUESTRA) {
+      Serial.println("Muestra descartada tras varios reintentos");
+      muestraPendiente = "";
+      reintentosPendiente = 0;
+    } else {
+      return;  // El servidor sigue sin responder: no apilar más muestras
+    }
+  }
   
   // Construir JSON con datos del sistema + setpoints actuales
+  numeroSecuencia++;
   String json = "{";
+  json += "\"seq\":" + String(numeroSecuencia) + ",";
+  json += "\"boot_id\":" + String(idArranque) + ",";
+  time_t ahora = time(nullptr);
+  if ((unsigned long)ahora > EPOCH_VALIDO) {
+    json += "\"device_ts\":" + String((unsigned long)ahora) + ",";
+  }
   json += "\"estado\":\"" + obtenerNombreEstado() + "\",";
   json += "\"fase\":\"" + obtenerNombreFase() + "\",";
   json += "\"vehiculos_dir1\":" + String(vehicleCount1) + ",";
@@ -234,26 +316,11 @@ void enviarDatosServidor() {
   json += "\"contador_peatonal\":" + String(contadorPeatonalActivado);
   json += "}";
   
-  Serial.print("Enviando: ");
-  Serial.println(json);
-  
-  int httpCode = http.POST(json);
-  
-  if (httpCode > 0) {
-    String response = http.getString();
-    Serial.print("Respuesta servidor (");
-    Serial.print(httpCode);
-    Serial.print("): ");
-    Serial.println(response);
-    
-    // Procesar comandos del servidor
-    procesarComandoServidor(response);
-  } else {
-    Serial.print("Error HTTP: ");
-    Serial.println(http.errorToString(httpCode));
+  // Timeout o error de red: el servidor pudo haberla procesado sin que llegara la respuesta
+  if (!postearMuestra(json)) {
+    muestraPendiente = json;
+    reintentosPendiente = 0;
   }
-  
-  http.end();
 }
 
 // =================================================================
@@ -395,6 +462,7 @@ void procesarAjuste(String comando) {
 // =================================================================
 void setup() {
   Serial.begin(115200);
+  idArranque = esp_random();
   
   lcd.init();
   lcd.backlight();
@@ -437,7 +505,7 @@ void loop() {
   }
   
   // ===== ENVIAR DATOS AL SERVIDOR (cada 5 segundos) =====
-  if (tiempoActual - ultimoEnvioServidor >= SEND_INTERVAL) {
+  if (tiempoActual - ultimoEnvioServidor >= SEND_INTERVAL + esperaExtraEnvio) {
     enviarDatosServidor();
     ultimoEnvioServidor = tiempoActual;
     // IMPORTANTE: Recalcular tiempo después de operación HTTP lenta
@@ -0,0 +1,327 @@
+"""
+=================================================================
+ Análisis Histórico de Tráfico - Generación 2
+ Reportes diarios / por hora a partir de traffic_data.csv
+=================================================================
+ Ejecutar: python analisis_trafico.py traffic_data.csv [otros.csv ...]
+           python analisis_trafico.py datos/*.csv --por hora --procesos 8
+           python analisis_trafico.py traffic_data.csv --salida reporte.csv
+
+ Cada archivo se divide en bloques de bytes que se procesan en un
+ pool de procesos. Cada bloque devuelve acumulados por día/hora
+ (solo sumas y conteos), así que la memoria no depende del tamaño
+ del CSV y el resultado coincide con calcular_estadisticas().
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, groupby, repeat
+from operator import itemgetter
+import argparse
+import json
+import csv
+import sys
+import os
+
+from estadisticas import nuevo_acumulado, acumular, acumular_columnas, combinar, resumir
+
+# Intervalo de envío del ESP32 (SEND_INTERVAL): cada muestra representa 5s
+SEGUNDOS_POR_MUESTRA = 5
+
+# Cada bloque se separa en cadenas de Python: un proceso usa ~10x el tamaño
+# del bloque (~70 MB con 4 MB) y bloques más chicos no son más lentos
+TAMANO_BLOQUE_MB = 4
+
+# Longitud del prefijo del timestamp que define cada agrupación
+AGRUPACIONES = {
+    'dia': 10,    # YYYY-MM-DD
+    'hora': 13    # YYYY-MM-DD HH
+}
+
+COLUMNAS_REQUERIDAS = ["timestamp", "estado", "vehiculos_dir1", "vehiculos_dir2", "ldr1", "ldr2", "co2"]
+
+# Opcionales: los CSV anteriores no traen 'wifi_rssi' ni 'anomalias'
+COLUMNAS_USADAS = COLUMNAS_REQUERIDAS + ["wifi_rssi", "anomalias"]
+
+
+def leer_encabezado(ruta):
+    """Devuelve {columna: índice} y el tamaño en bytes del encabezado"""
+    with open(ruta, 'rb') as f:
+        linea = f.readline()
+    columnas = linea.decode('utf-8-sig').strip().split(',')
+    faltantes = [c for c in COLUMNAS_REQUERIDAS if c not in columnas]
+    if faltantes:
+        raise ValueError(f"{ruta}: faltan columnas {faltantes}")
+    return {c: i for i, c in enumerate(columnas)}, len(linea)
+
+
+def dividir_en_bloques(ruta, tamano_bloque):
+    """Parte el archivo en rangos de bytes [inicio, fin) para los procesos"""
+    indices, inicio = leer_encabezado(ruta)
+    tamano = os.path.getsize(ruta)
+    bloques = []
+    while inicio < tamano:
+        fin = min(inicio + tamano_bloque, tamano)
+        bloques.append((ruta, indices, inicio, fin))
+        inicio = fin
+    return bloques
+
+
+def numeros(columna, enteros=False):
+    """Convierte una columna de texto; int() directo es el caso rápido (el servidor escribe enteros)"""
+    try:
+        return list(map(int, columna))
+    except ValueError:
+        valores = list(map(float, columna))
+        return list(map(int, valores)) if enteros else valores
+
+
+def leer_texto(ruta, inicio, fin):
+    """Texto de las líneas que EMPIEZAN dentro de [inicio, fin), leído de una sola vez"""
+    with open(ruta, 'rb') as f:
+        # Si el bloque empieza a mitad de línea, esa línea pertenece al bloque anterior
+        if inicio > 0:
+            f.seek(inicio - 1)
+            if f.read(1) != b'\n':
+                f.readline()
+        posicion = f.tell()
+        if posicion >= fin:
+            return ''
+        contenido = f.read(fin - posicion)
+        if not contenido.endswith(b'\n'):
+            contenido += f.readline()
+    texto = contenido.decode('utf-8', errors='replace').replace('\r', '')
+    return texto if texto.endswith('\n') else texto + '\n'
+
+
+def separar_columnas(texto, indices):
+    """
+    Devuelve ({columna: lista de textos}, filas_invalidas) con solo las columnas que se usan.
+
+    Camino rápido: si todas las filas tienen el número de campos del encabezado
+    (lo normal en un CSV escrito por el servidor), el bloque se parte con un
+    solo split() y cada columna es un slice con paso: sin objetos por fila.
+    Si no (líneas vacías, comillas, filas truncadas), se usa csv.reader.
+    """
+    usadas = {c: i for c, i in indices.items() if c in COLUMNAS_USADAS}
+    total = len(indices)
+    if '"' not in texto:
+        campos = texto.replace('\n', ',').split(',')
+        if len(campos) == texto.count('\n') * total + 1:
+            del campos[-1]
+            return {c: campos[i::total] for c, i in usadas.items()}, 0
+
+    filas = [f for f in csv.reader(texto.splitlines()) if f]
+    minimo_campos = max(usadas.values()) + 1
+    completas = [f for f in filas if len(f) >= minimo_campos]
+    return {c: [f[i] for f in completas] for c, i in usadas.items()}, len(filas) - len(completas)
+
+
+def procesar_bloque(args):
+    """
+    Procesa las líneas que EMPIEZAN dentro de [inicio, fin).
+    Devuelve ({clave_grupo: acumulado}, filas_invalidas, filas_anomalas).
+
+    El CSV está en orden temporal, así que cada periodo es un tramo contiguo
+    de filas y se acumula por columnas. Las muestras marcadas en 'anomalias'
+    se excluyen, igual que en calcular_estadisticas() del servidor.
+    """
+    ruta, indices, inicio, fin, largo_clave = args
+    columnas, invalidas = separar_columnas(leer_texto(ruta, inicio, fin), indices)
+    anomalias = columnas.pop('anomalias', None)
+    anomalas = 0
+    if anomalias is not None and any(anomalias):
+        descartes = list(compress(range(len(anomalias)), anomalias))
+        anomalas = len(descartes)
+        columnas = {c: quitar_filas(col, descartes) for c, col in columnas.items()}
+
+    timestamps = columnas.pop('timestamp')
+    grupos = {}
+    desde = 0
+    for clave, filas in groupby(map(itemgetter(slice(None, largo_clave)), timestamps)):
+        hasta = desde + len(list(filas))
+        if len(clave) < largo_clave:
+            invalidas += hasta - desde
+            desde = hasta
+            continue
+        tramo = {c: col[desde:hasta] for c, col in columnas.items()}
+        desde = hasta
+        acum = grupos.get(clave)
+        if acum is None:
+            acum = grupos[clave] = nuevo_acumulado()
+        invalidas += acumular_tramo(acum, tramo)
+
+    return grupos, invalidas, anomalas
+
+
+def quitar_filas(columna, descartes):
+    """Copia de la columna sin las posiciones 'descartes' (pocas y en orden), por slices"""
+    resultado = []
+    previo = 0
+    for i in descartes:
+        resultado += columna[previo:i]
+        previo = i + 1
+    resultado += columna[previo:]
+    return resultado
+
+
+def acumular_tramo(acum, tramo):
+    """Acumula un tramo por columnas; devuelve cuántas filas se descartaron por valores inválidos"""
+    rssi = tramo.get('wifi_rssi')
+    try:
+        parciales = (
+            tramo['estado'],
+            numeros(tramo['vehiculos_dir1'], enteros=True),
+            numeros(tramo['vehiculos_dir2'], enteros=True),
+            numeros(tramo['co2']),
+            numeros(tramo['ldr1']),
+            numeros(tramo['ldr2']),
+            numeros([v for v in rssi if v]) if rssi is not None else ()
+        )
+    except ValueError:
+        # Algún valor no numérico: este tramo se procesa fila por fila
+        return acumular_filas(acum, zip(
+            tramo['estado'], tramo['vehiculos_dir1'], tramo['vehiculos_dir2'],
+            tramo['co2'], tramo['ldr1'], tramo['ldr2'],
+            rssi if rssi is not None else repeat('')
+        ))
+    acumular_columnas(acum, *parciales)
+    return 0
+
+
+def acumular_filas(acum, filas):
+    """Camino lento para tramos con valores inválidos; devuelve cuántas filas se descartaron"""
+    invalidas = 0
+    for estado, d1, d2, co2, ldr1, ldr2, rssi in filas:
+        try:
+            valores = (int(float(d1)), int(float(d2)), float(co2), float(ldr1), float(ldr2),
+                       float(rssi) if rssi else None)
+        except ValueError:
+            invalidas += 1
+            continue
+        acumular(acum, estado, *valores)
+    return invalidas
+
+
+def analizar_archivos(rutas, agrupacion='dia', procesos=None, tamano_bloque_mb=TAMANO_BLOQUE_MB, por_archivo=False):
+    """
+    Reparte los bloques de todos los archivos en un pool de procesos y
+    combina los acumulados. Devuelve ({(origen, clave): acumulado}, filas_invalidas, filas_anomalas).
+    """
+    largo_clave = AGRUPACIONES[agrupacion]
+    tamano_bloque = max(1, int(tamano_bloque_mb * 1024 * 1024))
+
+    tareas = []
+    for ruta in rutas:
+        for ruta_b, indices, inicio, fin in dividir_en_bloques(ruta, tamano_bloque):
+            tareas.append((ruta_b, indices, inicio, fin, largo_clave))
+
+    resultado = {}
+    invalidas_total = 0
+    anomalas_total = 0
+
+    def incorporar(ruta, grupos, invalidas, anomalas):
+        nonlocal invalidas_total, anomalas_total
+        invalidas_total += invalidas
+        anomalas_total += anomalas
+        origen = os.path.splitext(os.path.basename(ruta))[0] if por_archivo else "todos"
+        for clave, acum in grupos.items():
+            destino = resultado.get((origen, clave))
+            if destino is None:
+                resultado[(origen, clave)] = acum
+            else:
+                combinar(destino, acum)
+
+    if procesos == 1 or len(tareas) <= 1:
+        for tarea in tareas:
+            incorporar(tarea[0], *procesar_bloque(tarea))
+    else:
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            for tarea, parcial in zip(tareas, pool.map(procesar_bloque, tareas)):
+                incorporar(tarea[0], *parcial)
+
+    return resultado, invalidas_total, anomalas_total
+
+
+def construir_reporte(resultado):
+    """Filas de reporte: estadísticas del dashboard + tiempo por estado, CO2 y RSSI"""
+    filas = []
+    for (origen, clave), acum in sorted(resultado.items()):
+        stats = resumir(acum)
+        if stats is None:
+            continue
+        fila = {'origen': origen, 'periodo': clave}
+        fila.update(stats)
+        fila['tiempo_estados_min'] = {
+            estado: round(cuenta * SEGUNDOS_POR_MUESTRA / 60, 1)
+            for estado, cuenta in acum['estados'].items()
+        }
+        fila['max_co2'] = acum['max_co2']
+        fila['minutos_co2_alto'] = round(acum['muestras_co2_alto'] * SEGUNDOS_POR_MUESTRA / 60, 1)
+        fila['avg_rssi'] = round(acum['suma_rssi'] / acum['n_rssi'], 1) if acum['n_rssi'] else None
+        fila['min_rssi'] = acum['min_rssi']
+        fila['pct_rssi_debil'] = round(acum['muestras_rssi_debil'] / acum['n_rssi'] * 100, 1) if acum['n_rssi'] else None
+        filas.append(fila)
+    return filas
+
+
+def guardar_reporte_csv(filas, ruta):
+    """Exporta el reporte a CSV (una columna por estado) para hojas de cálculo"""
+    estados = sorted({e for f in filas for e in f['tiempo_estados_min']})
+    columnas = ['origen', 'periodo', 'total_registros', 'total_vehiculos', 'total_dir1', 'total_dir2',
+                'pct_dir1', 'pct_dir2', 'avg_co2', 'max_co2', 'minutos_co2_alto', 'avg_luz',
+                'avg_rssi', 'min_rssi', 'pct_rssi_debil', 'estado_frecuente', 'direccion_dominante']
+    with open(ruta, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columnas + [f"min_{e}" for e in estados])
+        for fila in filas:
+            writer.writerow([fila[c] for c in columnas] + [fila['tiempo_estados_min'].get(e, 0) for e in estados])
+
+
+def imprimir_reporte(filas):
+    """Tabla resumida en consola"""
+    print(f"{'ORIGEN':<16} {'PERIODO':<13} {'REG':>7} {'D1':>8} {'D2':>8} {'%D1':>6} {'CO2':>7} {'RSSI':>6}  MODO FRECUENTE")
+    for f in filas:
+        rssi = f"{f['avg_rssi']:.0f}" if f['avg_rssi'] is not None else "-"
+        print(f"{f['origen'][:16]:<16} {f['periodo']:<13} {f['total_registros']:>7} {f['total_dir1']:>8} "
+              f"{f['total_dir2']:>8} {f['pct_dir1']:>6} {f['avg_co2']:>7} {rssi:>6}  {f['estado_frecuente']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reportes diarios/por hora de traffic_data.csv")
+    parser.add_argument('archivos', nargs='+', help="Archivos CSV generados por server.py")
+    parser.add_argument('--por', choices=sorted(AGRUPACIONES), default='dia', help="Agrupación (default: dia)")
+    parser.add_argument('--procesos', type=int, default=None, help="Procesos del pool (default: núcleos)")
+    parser.add_argument('--tamano-bloque', type=float, default=TAMANO_BLOQUE_MB,
+                        help=f"Tamaño de bloque en MB (default: {TAMANO_BLOQUE_MB})")
+    parser.add_argument('--por-archivo', action='store_true', help="Separar resultados por archivo (intersección)")
+    parser.add_argument('--salida', help="Guardar el reporte en CSV")
+    parser.add_argument('--json', action='store_true', help="Imprimir el reporte en JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        resultado, invalidas, anomalas = analizar_archivos(
+            args.archivos, args.por, args.procesos, args.tamano_bloque, args.por_archivo
+        )
+    except (OSError, ValueError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        return 1
+
+    filas = construir_reporte(resultado)
+
+    if args.salida:
+        guardar_reporte_csv(filas, args.salida)
+        print(f"💾 Reporte guardado en: {args.salida}", file=sys.stderr)
+    if args.json:
+        print(json.dumps(filas, ensure_ascii=False, indent=2))
+    elif not args.salida:
+        imprimir_reporte(filas)
+
+    if invalidas:
+        print(f"⚠️ Filas inválidas ignoradas: {invalidas}", file=sys.stderr)
+    if anomalas:
+        print(f"🚨 Muestras anómalas excluidas: {anomalas}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,384 @@
+"""
+=================================================================
+ Bitácora de Decisiones - Generación 2
+ Registro durable, compacto e indexado de cada ajuste AJUSTAR:*
+=================================================================
+ Cada decisión es un registro binario de tamaño fijo (40 bytes) que
+ solo se agrega al final de decisiones.bin. Los textos repetidos
+ (dispositivo, parámetro, regla) se guardan una sola vez en
+ nombres.txt y cada versión de CONFIG_ADAPTATIVO en configs.jsonl.
+
+ Al abrir se lee el archivo (un registro cortado por un corte de
+ luz se descarta) y solo se arma el índice global. Los índices por
+ dispositivo, por parámetro y por (dispositivo, parámetro) se arman
+ la primera vez que una consulta los usa, y desde ahí cada decisión
+ nueva se agrega a ellos. Cada índice guarda los tiempos ordenados,
+ así que un rango de fechas se busca con bisect sin recorrer la
+ bitácora completa.
+
+ Sin directorio la bitácora vive solo en memoria (gemelo digital).
+"""
+
+from itertools import accumulate, groupby
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import sub
+import struct
+import json
+import math
+import threading
+import sys
+import os
+
+# timestamp_ms, dispositivo, parámetro, regla, anterior, nuevo,
+# activaciones en ventana, registros en ventana, ratio D1, versión config
+REGISTRO = struct.Struct('<qIIIiiHHfI')
+
+ARCHIVO_REGISTROS = 'decisiones.bin'
+ARCHIVO_NOMBRES = 'nombres.txt'
+ARCHIVO_CONFIGS = 'configs.jsonl'
+
+MAX_CONTADOR = 0xFFFF
+
+# Familias de índices que se arman en la primera consulta que las usa
+FAMILIAS = ('d', 'p', 'dp')
+
+
+def abrir_bitacora(directorio=None, fsync=True):
+    """Abre (o crea) la bitácora en 'directorio'; sin directorio queda en memoria"""
+    bitacora = {
+        'directorio': directorio,
+        'fsync': fsync,
+        'datos': bytearray(),     # Copia de decisiones.bin (registros de tamaño fijo)
+        'n': 0,
+        'nombres': [],            # id → texto
+        'ids': {},                # texto → id
+        'configs': [],            # versión → CONFIG_ADAPTATIVO
+        'config_actual': None,    # JSON de la última versión (para detectar cambios)
+        'indices': {},            # clave → (tiempos, números de registro)
+        'familias': set(),        # Familias de índices ya armadas (ver _armar_familia)
+        'dispositivos': set(),    # Ids de dispositivo con alguna decisión
+        'lock': threading.Lock(), # Agregar un registro vs. armar una familia
+        'ultimo_ms': None,
+        'retroceso_max_ms': 0,    # Mayor diferencia entre el tiempo indexado y el real (ver _indexar)
+        'archivos': {}
+    }
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+        _cargar(bitacora)
+    if bitacora['n'] == 0:
+        # Sin registros no hay nada que armar: se indexa todo desde el primero
+        bitacora['familias'].update(FAMILIAS)
+    return bitacora
+
+
+def _ruta(bitacora, nombre):
+    return os.path.join(bitacora['directorio'], nombre)
+
+
+def _leer_completo(ruta, tamano_unidad=None):
+    """Contenido válido del archivo; recorta un final incompleto (escritura interrumpida)"""
+    if not os.path.exists(ruta):
+        return b''
+    with open(ruta, 'rb') as f:
+        contenido = f.read()
+    if tamano_unidad:
+        valido = len(contenido) - len(contenido) % tamano_unidad
+    else:
+        valido = contenido.rfind(b'\n') + 1
+    if valido < len(contenido):
+        print(f"⚠️ Bitácora: se descartan {len(contenido) - valido} bytes incompletos de {os.path.basename(ruta)}")
+        with open(ruta, 'r+b') as f:
+            f.truncate(valido)
+        contenido = contenido[:valido]
+    return contenido
+
+
+def _cargar(bitacora):
+    """Lee los tres archivos, arma el índice global y deja abiertos los archivos para agregar"""
+    for linea in _leer_completo(_ruta(bitacora, ARCHIVO_NOMBRES)).decode('utf-8').splitlines():
+        bitacora['ids'][linea] = len(bitacora['nombres'])
+        bitacora['nombres'].append(linea)
+
+    for linea in _leer_completo(_ruta(bitacora, ARCHIVO_CONFIGS)).decode('utf-8').splitlines():
+        bitacora['configs'].append(json.loads(linea)['config'])
+    if bitacora['configs']:
+        bitacora['config_actual'] = json.dumps(bitacora['configs'][-1], sort_keys=True)
+
+    datos = _leer_completo(_ruta(bitacora, ARCHIVO_REGISTROS), REGISTRO.size)
+    bitacora['datos'] = bytearray(datos)
+    _reconstruir_indices(bitacora, datos)
+    bitacora['n'] = len(datos) // REGISTRO.size
+
+    for nombre in (ARCHIVO_REGISTROS, ARCHIVO_NOMBRES, ARCHIVO_CONFIGS):
+        bitacora['archivos'][nombre] = open(_ruta(bitacora, nombre), 'ab')
+
+
+def _agrupar(numeros, columna):
+    """[(valor, números)] de 'numeros' agrupados por columna[n] (orden estable = orden temporal)"""
+    ordenados = sorted(numeros, key=columna.__getitem__)
+    return [(valor, list(grupo)) for valor, grupo in groupby(ordenados, key=columna.__getitem__)]
+
+
+def _columnas(datos, tipo):
+    """
+    Los registros como enteros de 8 ('q') o 4 ('I') bytes, sin desempaquetarlos
+    uno por uno: el registro mide 40 bytes = 5 enteros de 8 bytes = 10 de 4 bytes
+    """
+    palabras = array(tipo, datos)
+    if sys.byteorder != 'little':
+        palabras.byteswap()
+    return palabras
+
+
+def _reconstruir_indices(bitacora, datos):
+    """Índice global y dispositivos al abrir; el resto de los índices se arma al consultar"""
+    n = len(datos) // REGISTRO.size
+    if n == 0:
+        return
+    reales = _columnas(datos, 'q')[0::REGISTRO.size // 8]
+    tiempos = array('q', accumulate(reales, max))  # Monotónico (ver _indexar)
+    bitacora['retroceso_max_ms'] = max(map(sub, tiempos, reales))
+    bitacora['dispositivos'].update(_columnas(datos, 'I')[2::REGISTRO.size // 4])
+    bitacora['indices'][None] = (tiempos, array('I', range(n)))
+    bitacora['ultimo_ms'] = tiempos[-1]
+
+
+def _claves_familia(familia, dispositivo, parametro):
+    """Clave del índice de la familia al que pertenece un registro"""
+    if familia == 'd':
+        return ('d', dispositivo)
+    if familia == 'p':
+        return ('p', parametro)
+    return ('dp', dispositivo, parametro)
+
+
+def _armar_familia(bitacora, familia):
+    """
+    Arma todos los índices de una familia ('d', 'p' o 'dp') con los registros
+    ya escritos. El armado (segundos con millones de registros) corre sin el
+    lock para no frenar a registrar_decision; al final, bajo el lock, se
+    agregan los registros que llegaron mientras tanto y se publica la familia.
+    """
+    with bitacora['lock']:
+        if familia in bitacora['familias']:
+            return
+        n = bitacora['n']
+        columnas = _columnas(bitacora['datos'], 'I')
+    dispositivos = columnas[2::REGISTRO.size // 4]
+    parametros = columnas[3::REGISTRO.size // 4]
+    tiempos = bitacora['indices'][None][0]
+
+    def indice(numeros):
+        return (array('q', map(tiempos.__getitem__, numeros)), array('I', numeros))
+
+    nuevos = {}
+    if familia == 'p':
+        for parametro, numeros in _agrupar(range(n), parametros):
+            nuevos[('p', parametro)] = indice(numeros)
+    else:
+        for dispositivo, numeros in _agrupar(range(n), dispositivos):
+            if familia == 'd':
+                nuevos[('d', dispositivo)] = indice(numeros)
+                continue
+            for parametro, del_par in _agrupar(numeros, parametros):
+                nuevos[('dp', dispositivo, parametro)] = indice(del_par)
+
+    with bitacora['lock']:
+        if familia in bitacora['familias']:
+            return
+        datos = bitacora['datos']
+        for numero in range(n, bitacora['n']):
+            campos = REGISTRO.unpack_from(datos, numero * REGISTRO.size)
+            indice_nuevo = nuevos.setdefault(_claves_familia(familia, campos[1], campos[2]),
+                                             (array('q'), array('I')))
+            indice_nuevo[1].append(numero)
+            indice_nuevo[0].append(tiempos[numero])
+        bitacora['indices'].update(nuevos)
+        bitacora['familias'].add(familia)
+
+
+def cerrar_bitacora(bitacora):
+    for archivo in bitacora['archivos'].values():
+        archivo.close()
+    bitacora['archivos'] = {}
+
+
+def _escribir(bitacora, nombre, contenido):
+    """Agrega al archivo y lo baja a disco antes de seguir"""
+    archivo = bitacora['archivos'].get(nombre)
+    if archivo is None:
+        return
+    archivo.write(contenido)
+    archivo.flush()
+    if bitacora['fsync']:
+        os.fsync(archivo.fileno())
+
+
+def _id_nombre(bitacora, texto):
+    """Id del texto (se agrega a nombres.txt la primera vez)"""
+    texto = str(texto).replace('\n', ' ')
+    ident = bitacora['ids'].get(texto)
+    if ident is None:
+        ident = len(bitacora['nombres'])
+        _escribir(bitacora, ARCHIVO_NOMBRES, (texto + '\n').encode('utf-8'))
+        bitacora['nombres'].append(texto)
+        bitacora['ids'][texto] = ident
+    return ident
+
+
+def _version_config(bitacora, config):
+    """Versión de la configuración (se agrega a configs.jsonl si cambió)"""
+    serializada = json.dumps(config, sort_keys=True)
+    if serializada != bitacora['config_actual']:
+        version = len(bitacora['configs'])
+        linea = json.dumps({'version': version, 'config': config}, sort_keys=True) + '\n'
+        _escribir(bitacora, ARCHIVO_CONFIGS, linea.encode('utf-8'))
+        bitacora['configs'].append(json.loads(serializada))
+        bitacora['config_actual'] = serializada
+    return len(bitacora['configs']) - 1
+
+
+def _indexar(bitacora, numero, momento_ms, dispositivo, parametro):
+    """Agrega el registro al índice global y a las familias ya armadas (llamar con el lock tomado)"""
+    # Los índices deben quedar ordenados para bisect: si el reloj retrocede
+    # (NTP) se indexa con el máximo visto y el filtro usa el valor real.
+    # 'retroceso_max_ms' acota cuánto puede pasarse el tiempo indexado del real
+    if bitacora['ultimo_ms'] is not None and momento_ms < bitacora['ultimo_ms']:
+        bitacora['retroceso_max_ms'] = max(bitacora['retroceso_max_ms'], bitacora['ultimo_ms'] - momento_ms)
+        momento_ms = bitacora['ultimo_ms']
+    bitacora['ultimo_ms'] = momento_ms
+
+    bitacora['dispositivos'].add(dispositivo)
+    claves = [None] + [_claves_familia(familia, dispositivo, parametro) for familia in bitacora['familias']]
+    indices = bitacora['indices']
+    for clave in claves:
+        indice = indices.get(clave)
+        if indice is None:
+            indice = indices[clave] = (array('q'), array('I'))
+        # Primero el número y después el tiempo: un lector concurrente
+        # se guía por len(tiempos) y nunca ve un tiempo sin su registro
+        indice[1].append(numero)
+        indice[0].append(momento_ms)
+
+
+def registrar_decision(bitacora, momento_ms, dispositivo, parametro, regla, anterior, nuevo,
+                       activaciones=0, registros=0, ratio=None, config=None):
+    """Agrega una decisión (durable antes de volver si la bitácora tiene directorio)"""
+    id_dispositivo = _id_nombre(bitacora, dispositivo)
+    id_parametro = _id_nombre(bitacora, parametro)
+    registro = REGISTRO.pack(
+        int(momento_ms),
+        id_dispositivo,
+        id_parametro,
+        _id_nombre(bitacora, regla),
+        int(anterior),
+        int(nuevo),
+        min(int(activaciones), MAX_CONTADOR),
+        min(int(registros), MAX_CONTADOR),
+        float('nan') if ratio is None else ratio,
+        _version_config(bitacora, config or {})
+    )
+    _escribir(bitacora, ARCHIVO_REGISTROS, registro)
+
+    with bitacora['lock']:
+        numero = bitacora['n']
+        bitacora['datos'] += registro
+        bitacora['n'] = numero + 1
+        _indexar(bitacora, numero, int(momento_ms), id_dispositivo, id_parametro)
+
+
+def _a_dict(bitacora, numero, campos):
+    nombres = bitacora['nombres']
+    momento_ms, dispositivo, parametro, regla, anterior, nuevo, activaciones, registros, ratio, version = campos
+    return {
+        'numero': numero,
+        'timestamp_ms': momento_ms,
+        'device_id': nombres[dispositivo],
+        'parametro': nombres[parametro],
+        'regla': nombres[regla],
+        'valor_anterior': anterior,
+        'valor_nuevo': nuevo,
+        'activaciones_ventana': activaciones,
+        'registros_ventana': registros,
+        'ratio_d1': None if math.isnan(ratio) else round(ratio, 4),
+        'version_config': version
+    }
+
+
+def consultar(bitacora, dispositivo=None, parametro=None, regla=None, direccion=None,
+              desde_ms=None, hasta_ms=None, limite=100, recientes_primero=True):
+    """
+    Decisiones que cumplen los filtros. 'direccion' es 'subida' o 'bajada'.
+    Usa el índice más selectivo y bisect sobre el rango [desde_ms, hasta_ms].
+    'limite' en 0 o None devuelve todas (el endpoint siempre pasa un tope).
+
+    Los tiempos indexados nunca son menores que los reales (ver _indexar),
+    así que 'desde_ms' se busca directo. Un registro con tiempo real
+    <= hasta_ms puede estar indexado hasta 'retroceso_max_ms' después:
+    el rango se extiende esa holgura y se filtra por el tiempo real.
+    """
+    ids = bitacora['ids']
+    if (dispositivo is not None and dispositivo not in ids) or \
+       (parametro is not None and parametro not in ids) or \
+       (regla is not None and regla not in ids):
+        return []
+
+    if dispositivo is not None and parametro is not None:
+        clave = ('dp', ids[dispositivo], ids[parametro])
+    elif dispositivo is not None:
+        clave = ('d', ids[dispositivo])
+    elif parametro is not None:
+        clave = ('p', ids[parametro])
+    else:
+        clave = None
+    if clave is not None and clave[0] not in bitacora['familias']:
+        _armar_familia(bitacora, clave[0])
+    indice = bitacora['indices'].get(clave)
+    if indice is None:
+        return []
+
+    tiempos, numeros = indice
+    fin = len(tiempos)
+    inicio = bisect_left(tiempos, desde_ms, 0, fin) if desde_ms is not None else 0
+    if hasta_ms is not None:
+        fin = bisect_right(tiempos, hasta_ms + bitacora['retroceso_max_ms'], inicio, fin)
+
+    id_regla = ids[regla] if regla is not None else None
+    posiciones = range(fin - 1, inicio - 1, -1) if recientes_primero else range(inicio, fin)
+    datos = bitacora['datos']
+    resultado = []
+    for posicion in posiciones:
+        numero = numeros[posicion]
+        campos = REGISTRO.unpack_from(datos, numero * REGISTRO.size)
+        if id_regla is not None and campos[3] != id_regla:
+            continue
+        if direccion == 'subida' and campos[5] <= campos[4]:
+            continue
+        if direccion == 'bajada' and campos[5] >= campos[4]:
+            continue
+        if (desde_ms is not None and campos[0] < desde_ms) or (hasta_ms is not None and campos[0] > hasta_ms):
+            continue
+        resultado.append(_a_dict(bitacora, numero, campos))
+        if limite and len(resultado) >= limite:
+            break
+    return resultado
+
+
+def obtener_config(bitacora, version):
+    """CONFIG_ADAPTATIVO vigente en una versión registrada"""
+    if 0 <= version < len(bitacora['configs']):
+        return bitacora['configs'][version]
+    return None
+
+
+def resumen_bitacora(bitacora):
+    """Tamaño de la bitácora para el endpoint de diagnóstico"""
+    return {
+        'registros': bitacora['n'],
+        'bytes': len(bitacora['datos']),
+        'dispositivos': len(bitacora['dispositivos']),
+        'indices_armados': [f for f in FAMILIAS if f in bitacora['familias']],
+        'versiones_config': len(bitacora['configs']),
+        'durable': bool(bitacora['directorio'])
+    }
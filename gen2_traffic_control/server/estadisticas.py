@@ -0,0 +1,158 @@
+"""
+=================================================================
+ Estadísticas de Tráfico - Generación 2
+ Acumuladores combinables compartidos por el servidor y la CLI
+=================================================================
+ Un "acumulado" guarda solo sumas y conteos, así que se puede
+ calcular por bloques (o en varios procesos) y combinar después.
+"""
+
+from collections import Counter
+
+# Umbral de CO2 del ESP32 (CO2_HIGH_THRESHOLD en el firmware)
+CO2_ALTO = 600
+
+# RSSI por debajo de este valor se considera señal débil
+RSSI_DEBIL_DBM = -80
+
+
+def nuevo_acumulado():
+    """Acumulado vacío"""
+    return {
+        'n': 0,
+        'dir1': 0,
+        'dir2': 0,
+        'suma_co2': 0.0,
+        'max_co2': 0.0,
+        'muestras_co2_alto': 0,
+        'suma_luz': 0.0,
+        'estados': {},
+        'n_rssi': 0,
+        'suma_rssi': 0.0,
+        'min_rssi': None,
+        'muestras_rssi_debil': 0
+    }
+
+
+def acumular(acum, estado, d1, d2, co2, ldr1, ldr2, rssi=None):
+    """Agrega una muestra al acumulado"""
+    acum['n'] += 1
+    acum['dir1'] += d1
+    acum['dir2'] += d2
+    acum['suma_co2'] += co2
+    if co2 > acum['max_co2']:
+        acum['max_co2'] = co2
+    if co2 > CO2_ALTO:
+        acum['muestras_co2_alto'] += 1
+    acum['suma_luz'] += (ldr1 + ldr2) / 2
+    estados = acum['estados']
+    estados[estado] = estados.get(estado, 0) + 1
+
+    if rssi is not None:
+        acum['n_rssi'] += 1
+        acum['suma_rssi'] += rssi
+        if acum['min_rssi'] is None or rssi < acum['min_rssi']:
+            acum['min_rssi'] = rssi
+        if rssi < RSSI_DEBIL_DBM:
+            acum['muestras_rssi_debil'] += 1
+
+
+def acumular_columnas(acum, estados, d1, d2, co2, ldr1, ldr2, rssi=()):
+    """
+    Agrega un bloque de muestras dado por columnas (listas paralelas).
+    Equivale a llamar acumular() fila por fila, pero las sumas y conteos
+    se hacen con funciones nativas (sum/map/max) en lugar de un bucle Python.
+    'rssi' solo trae los valores presentes.
+    """
+    if not estados:
+        return
+    acum['n'] += len(estados)
+    acum['dir1'] += sum(d1)
+    acum['dir2'] += sum(d2)
+    acum['suma_co2'] += sum(co2)
+    acum['max_co2'] = max(acum['max_co2'], max(co2))
+    acum['muestras_co2_alto'] += sum(map(float(CO2_ALTO).__lt__, co2))
+    acum['suma_luz'] += (sum(ldr1) + sum(ldr2)) / 2
+    conteo = acum['estados']
+    for estado, cuenta in Counter(estados).items():
+        conteo[estado] = conteo.get(estado, 0) + cuenta
+
+    if rssi:
+        acum['n_rssi'] += len(rssi)
+        acum['suma_rssi'] += sum(rssi)
+        minimo = min(rssi)
+        if acum['min_rssi'] is None or minimo < acum['min_rssi']:
+            acum['min_rssi'] = minimo
+        acum['muestras_rssi_debil'] += sum(map(float(RSSI_DEBIL_DBM).__gt__, rssi))
+
+
+def combinar(destino, origen):
+    """Suma 'origen' dentro de 'destino' (resultado de otro bloque o proceso)"""
+    for clave in ('n', 'dir1', 'dir2', 'suma_co2', 'muestras_co2_alto', 'suma_luz',
+                  'n_rssi', 'suma_rssi', 'muestras_rssi_debil'):
+        destino[clave] += origen[clave]
+    destino['max_co2'] = max(destino['max_co2'], origen['max_co2'])
+    if origen['min_rssi'] is not None:
+        if destino['min_rssi'] is None or origen['min_rssi'] < destino['min_rssi']:
+            destino['min_rssi'] = origen['min_rssi']
+    for estado, cuenta in origen['estados'].items():
+        destino['estados'][estado] = destino['estados'].get(estado, 0) + cuenta
+    return destino
+
+
+def resumir(acum):
+    """Estadísticas del dashboard a partir de un acumulado (None si está vacío)"""
+    n = acum['n']
+    if not n:
+        return None
+
+    total_dir1 = acum['dir1']
+    total_dir2 = acum['dir2']
+    total_vehiculos = total_dir1 + total_dir2
+
+    # Promedios
+    avg_co2 = acum['suma_co2'] / n
+    avg_luz = acum['suma_luz'] / n
+
+    # Conteo de estados
+    estados_count = dict(acum['estados'])
+
+    # Estado más frecuente
+    estado_frecuente = max(estados_count, key=estados_count.get) if estados_count else "N/A"
+
+    # Porcentaje de tráfico por dirección
+    pct_dir1 = (total_dir1 / total_vehiculos * 100) if total_vehiculos > 0 else 50
+    pct_dir2 = (total_dir2 / total_vehiculos * 100) if total_vehiculos > 0 else 50
+
+    # Dirección dominante
+    if total_dir1 > total_dir2 * 1.2:
+        direccion_dominante = "Dirección 1 (+20%)"
+    elif total_dir2 > total_dir1 * 1.2:
+        direccion_dominante = "Dirección 2 (+20%)"
+    else:
+        direccion_dominante = "Equilibrado"
+
+    # Recomendación
+    if pct_dir1 > 60:
+        recomendacion = "⚡ Aumentar tiempo verde Dir1"
+    elif pct_dir2 > 60:
+        recomendacion = "⚡ Aumentar tiempo verde Dir2"
+    elif avg_co2 > 400:
+        recomendacion = "🌿 CO2 alto - ciclos largos activos"
+    else:
+        recomendacion = "✅ Sistema balanceado"
+
+    return {
+        'total_registros': n,
+        'total_vehiculos': total_vehiculos,
+        'total_dir1': total_dir1,
+        'total_dir2': total_dir2,
+        'pct_dir1': round(pct_dir1, 1),
+        'pct_dir2': round(pct_dir2, 1),
+        'avg_co2': round(avg_co2, 1),
+        'avg_luz': round(avg_luz, 1),
+        'estados_count': estados_count,
+        'estado_frecuente': estado_frecuente,
+        'direccion_dominante': direccion_dominante,
+        'recomendacion': recomendacion
+    }
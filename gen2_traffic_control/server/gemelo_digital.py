@@ -0,0 +1,643 @@
+"""
+=================================================================
+ Gemelo Digital del Controlador Gen2 (ESP32)
+ Simulación por eventos discretos, más rápida que el tiempo real
+=================================================================
+ Ejecutar: python gemelo_digital.py --intersecciones 100 --dias 1
+           python gemelo_digital.py --dias 7 --sin-auto --json
+           python gemelo_digital.py --intersecciones 1000 --sin-anomalias --procesos 8
+
+ Un proceso simula ~150.000 intersecciones-segundo por segundo real
+ sin detectores de anomalías: 1.000x tiempo real con ~150 intersecciones
+ por proceso (la lógica del servidor cuesta lo mismo en cada envío).
+
+ Reproduce la máquina de estados de gen2_traffic_control.ino
+ (modos, fases, setpoints, modo peatonal, procesarComandoServidor y
+ procesarAjuste) sobre un reloj simulado. Cada 5s simulados cada
+ intersección "envía" su JSON a la lógica de decisión de server.py
+ en el mismo proceso y aplica el comando que devuelve. Los
+ temporizadores del servidor (cooldowns, ventanas que expiran)
+ avanzan con el mismo reloj simulado.
+
+ Diferencias con el firmware: los sensores se evalúan en cada evento
+ (no cada 50ms), cada vehículo suma 1 al contador y se omiten los
+ delay() del LCD y la latencia HTTP.
+"""
+
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import heapq
+import random
+import json
+import math
+import time
+import sys
+import os
+
+import server
+
+# =================================================================
+#  CONSTANTES DEL FIRMWARE (gen2_traffic_control.ino)
+# =================================================================
+SEND_INTERVAL = 5000
+NIGHT_MODE_THRESHOLD = 300
+HEAVY_TRAFFIC_DIFF = 3
+CO2_HIGH_THRESHOLD = 600
+TIEMPO_RESET_CONTADOR = 60000
+COOLDOWN_PEATONAL = 3000
+DURACION_MODO_FORZADO = 30000
+COOLDOWN_CAMBIO_MODO = 5000
+
+SETPOINTS_INICIALES = {
+    'SP_VERDE_NORMAL': 10000,
+    'SP_AMARILLO': 3000,
+    'SP_VERDE_NOCTURNO': 6000,
+    'SP_VERDE_PESADO_MAX': 15000,
+    'SP_VERDE_PESADO_MIN': 5000,
+    'SP_VERDE_EMISION': 20000,
+    'SP_PEATONAL': 15000
+}
+
+# Setpoints que acepta procesarAjuste()
+SETPOINTS_AJUSTABLES = ('SP_VERDE_NORMAL', 'SP_PEATONAL', 'SP_VERDE_PESADO_MAX', 'SP_VERDE_PESADO_MIN')
+
+# Orden del ciclo: fase que se ejecuta → siguiente fase
+SIGUIENTE_FASE = {
+    'TL1_VERDE': 'TL1_AMARILLO',
+    'TL1_AMARILLO': 'TL1_ROJO',
+    'TL1_ROJO': 'TL2_VERDE',
+    'TL2_VERDE': 'TL2_AMARILLO',
+    'TL2_AMARILLO': 'TL2_ROJO',
+    'TL2_ROJO': 'TL1_VERDE'
+}
+
+# Perfil del entorno (vehículos/minuto por hora del día)
+PERFIL_DIR1 = [2, 1, 1, 1, 2, 6, 14, 22, 20, 12, 9, 9, 10, 9, 9, 10, 12, 14, 12, 9, 6, 4, 3, 2]
+PERFIL_DIR2 = [2, 1, 1, 1, 2, 4, 8, 10, 10, 9, 9, 9, 10, 9, 10, 14, 20, 22, 16, 10, 6, 4, 3, 2]
+PERFIL_PEATONES = [0, 0, 0, 0, 0, 1, 3, 6, 6, 4, 3, 4, 6, 5, 4, 4, 5, 6, 5, 3, 2, 1, 1, 0]  # por hora
+
+# Servidor: variables globales de decisión que se guardan por intersección
+ESTADO_SERVIDOR = ('setpoints_actuales', 'historial_peatonal', 'historial_desbalance',
+                   'ultimo_ajuste_timestamp', 'ultimo_comando_auto', 'razon_comando',
+                   'historial_decisiones')
+
+# Globales del servidor que simular() reemplaza y restaura al terminar
+GLOBALES_SIMULACION = ESTADO_SERVIDOR + ('obtener_ahora', 'modo_automatico', 'LOG_DETALLADO',
+                                         'detectores_anomalias', 'historial_anomalias',
+                                         'rueda', 'bitacora')
+
+
+# =================================================================
+#  ESTADO DE UNA INTERSECCIÓN
+# =================================================================
+def nuevo_controlador(numero, rng):
+    """Estado del firmware + entorno + estado del servidor para una intersección"""
+    return {
+        'device_id': f"gemelo-{numero:05d}",
+        'rng': rng,
+        'escala_trafico': rng.uniform(0.5, 1.5),
+        'escala_peatones': rng.uniform(0.5, 2.0),
+        'sp': dict(SETPOINTS_INICIALES),
+
+        # Firmware
+        'estado': 'NORMAL',
+        'fase': 'TL1_VERDE',
+        'version_fase': 0,            # Invalida eventos de fase obsoletos
+        'vehiculos_dir1': 0,
+        'vehiculos_dir2': 0,
+        'ldr1': 0,
+        'ldr2': 0,
+        'co2': 0,
+        'contador_peatonal': 0,
+        'solicitud_peatonal': False,
+        'inicio_peatonal': 0,
+        'fin_peatonal': 0,
+        'version_peatonal': 0,
+        'forzado': False,
+        'tiempo_forzado': 0,
+        'ultimo_cambio_auto': 0,
+        'reset_pendiente': False,
+        'reevaluar_en': None,         # Evita encolar reevaluaciones repetidas
+        'seq': 0,
+        'comando_temporizador': None, # Decidido por un timer del servidor, se entrega en el próximo envío
+
+        # Servidor (se intercambia en server.py antes de decidir)
+        'servidor': {
+            'setpoints_actuales': dict(server.setpoints_actuales),
+            'historial_peatonal': [],
+            'historial_desbalance': [],
+            'ultimo_ajuste_timestamp': None,
+            'ultimo_comando_auto': None,
+            'razon_comando': "",
+            'historial_decisiones': []
+        },
+
+        # Métricas
+        'ms_por_estado': {},
+        'ultimo_cambio_estado': 0,
+        'ajustes': [],
+        'activaciones_peatonales': 0,
+        'solicitudes_bloqueadas': 0
+    }
+
+
+def cambiar_estado(ctrl, nuevo, t):
+    """Cambia el modo acumulando el tiempo pasado en el anterior"""
+    if nuevo == ctrl['estado']:
+        return
+    ms = ctrl['ms_por_estado']
+    ms[ctrl['estado']] = ms.get(ctrl['estado'], 0) + t - ctrl['ultimo_cambio_estado']
+    ctrl['ultimo_cambio_estado'] = t
+    ctrl['estado'] = nuevo
+
+
+# =================================================================
+#  SIMULADOR DE EVENTOS DISCRETOS
+# =================================================================
+def nueva_simulacion(inicio, auto=True, anomalias=True):
+    return {
+        'inicio': inicio,
+        't': 0,               # Reloj simulado en ms (millis() del ESP32)
+        'cola': [],
+        'contador': 0,        # Desempate estable de la cola
+        'auto': auto,
+        'anomalias': anomalias,  # False: las muestras simuladas no pasan por los detectores
+        'controladores': [],
+        'por_dispositivo': {},
+        'eventos': 0,
+        'envios': 0
+    }
+
+
+def programar(sim, t, tipo, ctrl, dato=None):
+    sim['contador'] += 1
+    heapq.heappush(sim['cola'], (t, sim['contador'], tipo, ctrl, dato))
+
+
+def hora_del_dia(sim, t):
+    """Hora decimal simulada (0-24)"""
+    momento = sim['inicio'] + timedelta(milliseconds=t)
+    return momento.hour + momento.minute / 60
+
+
+def siguiente_llegada(ctrl, t, vehiculos_por_minuto):
+    """Proceso de Poisson: instante de la siguiente llegada en ms"""
+    tasa = max(vehiculos_por_minuto, 0.01) / 60000
+    return t + int(ctrl['rng'].expovariate(tasa)) + 1
+
+
+# =================================================================
+#  FIRMWARE: LÓGICA DEL loop()
+# =================================================================
+def obtener_tiempos(ctrl):
+    """obtenerTiempos(): (verdeDir1, amarilloDir1, verdeDir2, amarilloDir2)"""
+    sp = ctrl['sp']
+    estado = ctrl['estado']
+    if estado == 'NOCTURNO':
+        return sp['SP_VERDE_NOCTURNO'], 2000, sp['SP_VERDE_NOCTURNO'], 2000
+    if estado == 'TRAFICO_PESADO':
+        if ctrl['vehiculos_dir1'] > ctrl['vehiculos_dir2']:
+            return sp['SP_VERDE_PESADO_MAX'], sp['SP_AMARILLO'], sp['SP_VERDE_PESADO_MIN'], sp['SP_AMARILLO']
+        return sp['SP_VERDE_PESADO_MIN'], sp['SP_AMARILLO'], sp['SP_VERDE_PESADO_MAX'], sp['SP_AMARILLO']
+    if estado == 'EMISION':
+        return sp['SP_VERDE_EMISION'], 2000, sp['SP_VERDE_EMISION'], 2000
+    return sp['SP_VERDE_NORMAL'], sp['SP_AMARILLO'], sp['SP_VERDE_NORMAL'], sp['SP_AMARILLO']
+
+
+def ejecutar_fase(sim, ctrl, t):
+    """
+    ejecutarMaquinaEstados(): enciende la fase actual y avanza 'fase' a la
+    siguiente (igual que el firmware, 'fase' reporta la próxima fase).
+    """
+    verde1, amarillo1, verde2, amarillo2 = obtener_tiempos(ctrl)
+    fase = ctrl['fase']
+    if fase == 'TL1_VERDE':
+        duracion = verde1
+    elif fase == 'TL1_AMARILLO':
+        duracion = amarillo1
+    elif fase == 'TL2_VERDE':
+        duracion = verde2
+    elif fase == 'TL2_AMARILLO':
+        duracion = amarillo2
+    else:
+        duracion = 1000  # Todo rojo de seguridad
+    ctrl['fase'] = SIGUIENTE_FASE[fase]
+    ctrl['version_fase'] += 1
+    programar(sim, t + duracion, 'fase', ctrl, ctrl['version_fase'])
+
+
+def reiniciar_ciclo(sim, ctrl, t):
+    """faseActual = FASE_TL1_VERDE; duracionFaseActual = 0 → entra de inmediato"""
+    ctrl['fase'] = 'TL1_VERDE'
+    ejecutar_fase(sim, ctrl, t)
+
+
+def determinar_modo(sim, ctrl, t):
+    """determinarModo(): modo forzado, cooldown y reglas por sensores"""
+    if ctrl['forzado']:
+        if t - ctrl['tiempo_forzado'] < DURACION_MODO_FORZADO:
+            return
+        ctrl['forzado'] = False
+
+    if t - ctrl['ultimo_cambio_auto'] < COOLDOWN_CAMBIO_MODO:
+        programar_reevaluacion(sim, ctrl, ctrl['ultimo_cambio_auto'] + COOLDOWN_CAMBIO_MODO)
+        return
+
+    anterior = ctrl['estado']
+    if ctrl['co2'] > CO2_HIGH_THRESHOLD:
+        nuevo = 'EMISION'
+    elif ctrl['ldr1'] < NIGHT_MODE_THRESHOLD and ctrl['ldr2'] < NIGHT_MODE_THRESHOLD:
+        nuevo = 'NOCTURNO'
+    elif abs(ctrl['vehiculos_dir1'] - ctrl['vehiculos_dir2']) >= HEAVY_TRAFFIC_DIFF:
+        nuevo = 'TRAFICO_PESADO'
+    else:
+        nuevo = 'NORMAL'
+
+    if nuevo != anterior:
+        cambiar_estado(ctrl, nuevo, t)
+        ctrl['ultimo_cambio_auto'] = t
+        reiniciar_ciclo(sim, ctrl, t)
+
+
+def programar_reevaluacion(sim, ctrl, t):
+    """Vuelve a evaluar el modo cuando vence un cooldown o el modo forzado"""
+    if ctrl['reevaluar_en'] is not None and ctrl['reevaluar_en'] <= t:
+        return
+    ctrl['reevaluar_en'] = t
+    programar(sim, t, 'reevaluar', ctrl)
+
+
+def activar_peatonal(sim, ctrl, t):
+    """activarModoPeatonal(): 3s amarillo + SP_PEATONAL rojo + 2s intermitente"""
+    cambiar_estado(ctrl, 'PEATONAL', t)
+    ctrl['solicitud_peatonal'] = False
+    ctrl['inicio_peatonal'] = t
+    ctrl['contador_peatonal'] += 1
+    ctrl['activaciones_peatonales'] += 1
+    ctrl['version_fase'] += 1  # La máquina de fases se detiene
+    programar_fin_peatonal(sim, ctrl, t)
+
+
+def programar_fin_peatonal(sim, ctrl, t):
+    ctrl['version_peatonal'] += 1
+    fin = max(ctrl['inicio_peatonal'] + 3000 + ctrl['sp']['SP_PEATONAL'] + 2000, t)
+    programar(sim, fin, 'fin_peatonal', ctrl, ctrl['version_peatonal'])
+
+
+def finalizar_peatonal(sim, ctrl, t):
+    """Fin de ejecutarModoPeatonal(): vuelve a NORMAL desde TL1_VERDE"""
+    cambiar_estado(ctrl, 'NORMAL', t)
+    ctrl['fase'] = 'TL1_VERDE'
+    ctrl['fin_peatonal'] = t
+    ctrl['solicitud_peatonal'] = False
+    if ctrl['reset_pendiente']:
+        resetear_contadores(sim, ctrl, t)
+    paso_loop(sim, ctrl, t, fase_pendiente=True)
+
+
+def resetear_contadores(sim, ctrl, t):
+    ctrl['vehiculos_dir1'] = 0
+    ctrl['vehiculos_dir2'] = 0
+    ctrl['reset_pendiente'] = False
+    programar(sim, t + TIEMPO_RESET_CONTADOR, 'reset', ctrl)
+
+
+def paso_loop(sim, ctrl, t, fase_pendiente=False):
+    """Parte del loop() que depende de entradas: solicitud peatonal y modo"""
+    if ctrl['solicitud_peatonal'] and ctrl['estado'] != 'PEATONAL' and ctrl['co2'] <= CO2_HIGH_THRESHOLD:
+        if t - ctrl['fin_peatonal'] >= COOLDOWN_PEATONAL:
+            activar_peatonal(sim, ctrl, t)
+        else:
+            ctrl['solicitud_peatonal'] = False
+            ctrl['solicitudes_bloqueadas'] += 1
+    elif ctrl['solicitud_peatonal'] and ctrl['co2'] > CO2_HIGH_THRESHOLD:
+        ctrl['solicitud_peatonal'] = False
+        ctrl['solicitudes_bloqueadas'] += 1
+
+    if ctrl['estado'] == 'PEATONAL':
+        return
+
+    fase_antes = ctrl['version_fase']
+    determinar_modo(sim, ctrl, t)
+    # duracionFaseActual = 0 (tras peatonal): entrar a la fase si el modo no la reinició
+    if fase_pendiente and ctrl['version_fase'] == fase_antes:
+        ejecutar_fase(sim, ctrl, t)
+
+
+def procesar_comando(sim, ctrl, comando, t):
+    """procesarComandoServidor() + procesarAjuste()"""
+    if comando.startswith("AJUSTAR:"):
+        partes = comando.split(':')
+        if len(partes) < 3:
+            return
+        parametro = partes[1]
+        try:
+            valor = int(partes[2])
+        except ValueError:
+            valor = 0  # String.toInt() devuelve 0
+        if parametro in SETPOINTS_AJUSTABLES:
+            anterior = ctrl['sp'][parametro]
+            ctrl['sp'][parametro] = valor
+            ctrl['ajustes'].append((t, parametro, anterior, valor))
+            if parametro == 'SP_PEATONAL' and ctrl['estado'] == 'PEATONAL':
+                programar_fin_peatonal(sim, ctrl, t)
+        elif parametro == "RESET_PEATONAL":
+            ctrl['contador_peatonal'] = 0
+        return
+
+    if comando == "PEATONAL":
+        ctrl['solicitud_peatonal'] = True
+    elif comando in ("NORMAL", "NOCTURNO"):
+        cambiar_estado(ctrl, comando, t)
+        ctrl['forzado'] = True
+        ctrl['tiempo_forzado'] = t
+        programar_reevaluacion(sim, ctrl, t + DURACION_MODO_FORZADO)
+        reiniciar_ciclo(sim, ctrl, t)
+
+
+def actualizar_ambiente(sim, ctrl, t):
+    """LDR y CO2 según la hora simulada (día/noche y horas pico)"""
+    hora = hora_del_dia(sim, t)
+    rng = ctrl['rng']
+    luz = max(0.0, math.sin((hora - 6) / 12 * math.pi))
+    base_luz = 100 + 3000 * luz
+    ctrl['ldr1'] = int(base_luz + rng.uniform(-50, 50))
+    ctrl['ldr2'] = int(base_luz + rng.uniform(-50, 50))
+    pico = max(PERFIL_DIR1[int(hora)], PERFIL_DIR2[int(hora)]) / 22
+    ctrl['co2'] = int(250 + 400 * pico * ctrl['escala_trafico'] + rng.uniform(-20, 20))
+
+
+# =================================================================
+#  COMUNICACIÓN CON LA LÓGICA DEL SERVIDOR (en proceso)
+# =================================================================
+def construir_json(sim, ctrl, t):
+    """Mismo JSON que enviarDatosServidor()"""
+    ctrl['seq'] += 1
+    momento = sim['inicio'] + timedelta(milliseconds=t)
+    sp = ctrl['sp']
+    return {
+        'device_id': ctrl['device_id'],
+        'seq': ctrl['seq'],
+        'device_ts': momento.timestamp(),
+        'timestamp': momento.isoformat(' ', 'seconds'),  # '%Y-%m-%d %H:%M:%S', más rápido que strftime
+        'tardio': False,
+        'estado': ctrl['estado'],
+        'fase': ctrl['fase'],
+        'vehiculos_dir1': ctrl['vehiculos_dir1'],
+        'vehiculos_dir2': ctrl['vehiculos_dir2'],
+        'ldr1': ctrl['ldr1'],
+        'ldr2': ctrl['ldr2'],
+        'co2': ctrl['co2'],
+        'wifi_rssi': -60,
+        'sp_verde_normal': sp['SP_VERDE_NORMAL'],
+        'sp_peatonal': sp['SP_PEATONAL'],
+        'sp_verde_pesado_max': sp['SP_VERDE_PESADO_MAX'],
+        'sp_verde_pesado_min': sp['SP_VERDE_PESADO_MIN'],
+        'contador_peatonal': ctrl['contador_peatonal']
+    }
+
+
+def enviar_al_servidor(sim, ctrl, t):
+    """Carga el estado de la intersección en server.py, decide y lo guarda de vuelta"""
+    data = construir_json(sim, ctrl, t)
+    sim['envios'] += 1
+    if not sim['auto']:
+        return None
+
+    cargar_estado_servidor(ctrl)
+    # Los detectores cuestan ~1/3 de cada envío; el entorno simulado no genera fallas de sensor
+    data['anomalias'] = server.detectar_anomalias(data) if sim['anomalias'] else {}
+    comando, _ = server.analizar_y_decidir(data)
+    guardar_estado_servidor(ctrl)
+
+    if not comando and ctrl['comando_temporizador']:
+        comando = ctrl['comando_temporizador']
+    ctrl['comando_temporizador'] = None
+    return comando
+
+
+def cargar_estado_servidor(ctrl):
+    vars(server).update(ctrl['servidor'])
+
+
+def guardar_estado_servidor(ctrl):
+    globales = vars(server)
+    ctrl['servidor'] = {nombre: globales[nombre] for nombre in ESTADO_SERVIDOR}
+
+
+def procesar_temporizadores(sim):
+    """Equivalente a server.procesar_temporizadores() con el estado de cada intersección"""
+    vencidos = server.avanzar(server.rueda, int(server.obtener_ahora().timestamp() * 1000))
+    for device_id in dict.fromkeys(clave[0] for clave, _ in vencidos):
+        ctrl = sim['por_dispositivo'].get(device_id)
+        if ctrl is None:
+            continue
+        cargar_estado_servidor(ctrl)
+        comando, _ = server.evaluar_reglas(device_id)
+        guardar_estado_servidor(ctrl)
+        if comando:
+            ctrl['comando_temporizador'] = comando
+
+
+# =================================================================
+#  BUCLE PRINCIPAL
+# =================================================================
+def agregar_interseccion(sim, numero, semilla):
+    rng = random.Random(semilla * 100003 + numero)
+    ctrl = nuevo_controlador(numero, rng)
+    sim['controladores'].append(ctrl)
+    sim['por_dispositivo'][ctrl['device_id']] = ctrl
+
+    # setup(): entrar a TL1_VERDE; desfasar envíos entre intersecciones
+    actualizar_ambiente(sim, ctrl, 0)
+    reiniciar_ciclo(sim, ctrl, 0)
+    programar(sim, rng.randint(1, SEND_INTERVAL), 'envio', ctrl)
+    programar(sim, TIEMPO_RESET_CONTADOR, 'reset', ctrl)
+    programar(sim, 60000, 'ambiente', ctrl)
+    programar(sim, siguiente_llegada(ctrl, 0, PERFIL_DIR1[0] * ctrl['escala_trafico']), 'vehiculo', ctrl, 1)
+    programar(sim, siguiente_llegada(ctrl, 0, PERFIL_DIR2[0] * ctrl['escala_trafico']), 'vehiculo', ctrl, 2)
+    programar(sim, siguiente_llegada(ctrl, 0, PERFIL_PEATONES[0] * ctrl['escala_peatones'] / 60), 'boton', ctrl)
+    return ctrl
+
+
+def ejecutar(sim, duracion_ms):
+    """Procesa eventos en orden temporal hasta 'duracion_ms'"""
+    cola = sim['cola']
+    while cola and cola[0][0] <= duracion_ms:
+        t, _, tipo, ctrl, dato = heapq.heappop(cola)
+        sim['t'] = t
+        sim['eventos'] += 1
+
+        if tipo == 'fase':
+            if dato == ctrl['version_fase'] and ctrl['estado'] != 'PEATONAL':
+                ejecutar_fase(sim, ctrl, t)
+
+        elif tipo == 'vehiculo':
+            hora = int(hora_del_dia(sim, t))
+            perfil = PERFIL_DIR1 if dato == 1 else PERFIL_DIR2
+            ctrl['vehiculos_dir1' if dato == 1 else 'vehiculos_dir2'] += 1
+            programar(sim, siguiente_llegada(ctrl, t, perfil[hora] * ctrl['escala_trafico']), 'vehiculo', ctrl, dato)
+            paso_loop(sim, ctrl, t)
+
+        elif tipo == 'boton':
+            hora = int(hora_del_dia(sim, t))
+            ctrl['solicitud_peatonal'] = True
+            programar(sim, siguiente_llegada(ctrl, t, PERFIL_PEATONES[hora] * ctrl['escala_peatones'] / 60), 'boton', ctrl)
+            paso_loop(sim, ctrl, t)
+
+        elif tipo == 'envio':
+            programar(sim, t + SEND_INTERVAL, 'envio', ctrl)
+            comando = enviar_al_servidor(sim, ctrl, t)
+            if comando:
+                procesar_comando(sim, ctrl, comando, t)
+            paso_loop(sim, ctrl, t)
+
+        elif tipo == 'fin_peatonal':
+            if dato == ctrl['version_peatonal'] and ctrl['estado'] == 'PEATONAL':
+                finalizar_peatonal(sim, ctrl, t)
+
+        elif tipo == 'reset':
+            if ctrl['estado'] == 'PEATONAL':
+                ctrl['reset_pendiente'] = True
+            else:
+                resetear_contadores(sim, ctrl, t)
+                paso_loop(sim, ctrl, t)
+
+        elif tipo == 'ambiente':
+            actualizar_ambiente(sim, ctrl, t)
+            programar(sim, t + 60000, 'ambiente', ctrl)
+            paso_loop(sim, ctrl, t)
+
+        elif tipo == 'reevaluar':
+            if ctrl['reevaluar_en'] == t:
+                ctrl['reevaluar_en'] = None
+            paso_loop(sim, ctrl, t)
+
+        elif tipo == 'temporizadores':
+            procesar_temporizadores(sim)
+            programar(sim, t + server.CONFIG_ADAPTATIVO['tick_temporizadores_ms'], 'temporizadores', None)
+
+    sim['t'] = duracion_ms
+
+
+def resumen(sim):
+    """Métricas por intersección al final de la simulación"""
+    filas = []
+    for ctrl in sim['controladores']:
+        # Incluir el tiempo del estado actual sin modificar el controlador
+        ms_por_estado = dict(ctrl['ms_por_estado'])
+        ms_por_estado[ctrl['estado']] = ms_por_estado.get(ctrl['estado'], 0) + sim['t'] - ctrl['ultimo_cambio_estado']
+        filas.append({
+            'device_id': ctrl['device_id'],
+            'minutos_por_estado': {e: round(ms / 60000, 1) for e, ms in ms_por_estado.items()},
+            'activaciones_peatonales': ctrl['activaciones_peatonales'],
+            'solicitudes_bloqueadas': ctrl['solicitudes_bloqueadas'],
+            'ajustes': len(ctrl['ajustes']),
+            'setpoints_finales': {k: ctrl['sp'][k] for k in SETPOINTS_AJUSTABLES}
+        })
+    return filas
+
+
+def simular(intersecciones=1, dias=1.0, semilla=1, auto=True, inicio=None, primera=0, anomalias=True):
+    """
+    Simula N intersecciones (numeradas desde 'primera') durante 'dias'
+    contra la lógica de server.py. Devuelve (simulación, segundos reales).
+    Con anomalias=False las muestras no pasan por los detectores.
+    Todas las globales del servidor que toca la simulación se restauran al final.
+    """
+    inicio = inicio or datetime(2026, 1, 1)
+    sim = nueva_simulacion(inicio, auto, anomalias)
+    globales = vars(server)
+    originales = {nombre: globales[nombre] for nombre in GLOBALES_SIMULACION}
+    server.obtener_ahora = lambda: sim['inicio'] + timedelta(milliseconds=sim['t'])
+    server.modo_automatico = auto
+    server.LOG_DETALLADO = False
+    # Detectores propios: las intersecciones simuladas no aparecen en /api/anomalias
+    server.detectores_anomalias = {}
+    server.historial_anomalias = []
+    # Rueda de temporizadores propia, sobre el reloj simulado
+    tick_ms = server.CONFIG_ADAPTATIVO['tick_temporizadores_ms']
+    server.rueda = server.nueva_rueda(tick_ms, int(inicio.timestamp() * 1000))
+    # Bitácora en memoria: las decisiones simuladas no ensucian la del servidor
+    server.bitacora = sim['bitacora'] = server.abrir_bitacora()
+
+    t0 = time.perf_counter()
+    try:
+        # Los print() que no controla LOG_DETALLADO no llegan a la consola
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            for numero in range(primera, primera + intersecciones):
+                agregar_interseccion(sim, numero, semilla)
+            if auto:
+                programar(sim, tick_ms, 'temporizadores', None)
+            ejecutar(sim, int(dias * 86400 * 1000))
+    finally:
+        globales.update(originales)
+    return sim, time.perf_counter() - t0
+
+
+def simular_tramo(args):
+    """Simula un tramo de intersecciones en un proceso del pool"""
+    sim, _ = simular(*args)
+    return resumen(sim), sim['eventos'], sim['envios']
+
+
+def simular_en_paralelo(intersecciones=1, dias=1.0, semilla=1, auto=True, procesos=None, anomalias=True):
+    """
+    Reparte las intersecciones entre procesos: cada una lleva su propio
+    estado del servidor, así que los tramos son independientes.
+    Devuelve (filas de resumen, eventos, envíos, segundos reales).
+    """
+    procesos = procesos or os.cpu_count() or 1
+    t0 = time.perf_counter()
+    if procesos == 1 or intersecciones <= 1:
+        sim, _ = simular(intersecciones, dias, semilla, auto, anomalias=anomalias)
+        return resumen(sim), sim['eventos'], sim['envios'], time.perf_counter() - t0
+
+    tamano = math.ceil(intersecciones / procesos)
+    tramos = [(min(tamano, intersecciones - primera), dias, semilla, auto, None, primera, anomalias)
+              for primera in range(0, intersecciones, tamano)]
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        partes = list(pool.map(simular_tramo, tramos))
+    filas = [fila for filas_tramo, _, _ in partes for fila in filas_tramo]
+    eventos = sum(p[1] for p in partes)
+    envios = sum(p[2] for p in partes)
+    return filas, eventos, envios, time.perf_counter() - t0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gemelo digital del controlador Gen2")
+    parser.add_argument('--intersecciones', type=int, default=1)
+    parser.add_argument('--dias', type=float, default=1.0)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--sin-auto', action='store_true', help="Desactiva el modo automático del servidor")
+    parser.add_argument('--sin-anomalias', action='store_true',
+                        help="No pasar las muestras por los detectores de anomalías (más rápido)")
+    parser.add_argument('--json', action='store_true', help="Imprimir métricas por intersección en JSON")
+    parser.add_argument('--procesos', type=int, default=None, help="Procesos del pool (default: núcleos)")
+    args = parser.parse_args(argv)
+
+    filas, eventos, envios, segundos = simular_en_paralelo(
+        args.intersecciones, args.dias, args.semilla, not args.sin_auto, args.procesos,
+        not args.sin_anomalias)
+    simulado = args.dias * 86400
+
+    if args.json:
+        print(json.dumps(filas, ensure_ascii=False, indent=2))
+    else:
+        for fila in filas[:20]:
+            print(f"🚦 {fila['device_id']}: {fila['ajustes']} ajustes, "
+                  f"{fila['activaciones_peatonales']} peatonales, SP final {fila['setpoints_finales']}")
+        if len(filas) > 20:
+            print(f"... ({len(filas) - 20} intersecciones más)")
+
+    print("=" * 60, file=sys.stderr)
+    print(f"⏱️  {args.intersecciones} intersecciones × {args.dias} días simulados en {segundos:.2f}s reales", file=sys.stderr)
+    print(f"⚡ Velocidad: {simulado / max(segundos, 1e-9):,.0f}x tiempo real | "
+          f"{eventos:,} eventos, {envios:,} envíos", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
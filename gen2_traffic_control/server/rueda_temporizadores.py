@@ -0,0 +1,157 @@
+"""
+=================================================================
+ Rueda de Temporizadores Jerárquica - Generación 2
+ Programación/cancelación O(1) para decenas de miles de timers
+=================================================================
+ Cuatro niveles de ranuras (como los timers del kernel de Linux):
+
+   nivel 0: 256 ranuras × 1 tick        (~4 min con tick de 1s)
+   nivel 1:  64 ranuras × 256 ticks     (~4.5 horas)
+   nivel 2:  64 ranuras × 16384 ticks   (~12 días)
+   nivel 3:  64 ranuras × 1048576 ticks (~2 años)
+
+ Un timer se guarda en el nivel que cubre su distancia; cuando el
+ nivel 0 da la vuelta, la ranura correspondiente del nivel superior
+ se "desciende" y sus timers se redistribuyen. Programar o cancelar
+ es O(1); cada timer se mueve como mucho una vez por nivel.
+
+ Reprogramar una clave reemplaza el timer anterior (cancelación
+ perezosa por generación, sin buscar en las ranuras).
+"""
+
+BITS_NIVELES = (8, 6, 6, 6)
+
+
+def nueva_rueda(tick_ms=1000, ahora_ms=0):
+    """Rueda vacía con resolución 'tick_ms' que empieza en 'ahora_ms'"""
+    return {
+        'tick_ms': tick_ms,
+        'actual': ahora_ms // tick_ms,       # Próximo tick a procesar
+        'niveles': [[[] for _ in range(1 << bits)] for bits in BITS_NIVELES],
+        'por_nivel': [0] * len(BITS_NIVELES),  # Entradas por nivel (para saltar niveles vacíos)
+        'activos': {},                       # {clave: generación}
+        'generacion': 0
+    }
+
+
+def _insertar(rueda, vence, clave, generacion, dato):
+    """Coloca el timer en el nivel según la distancia al tick actual"""
+    actual = rueda['actual']
+    distancia = vence - actual
+    if distancia < 0:
+        vence = actual
+        distancia = 0
+
+    desplazamiento = 0
+    for nivel, bits in enumerate(BITS_NIVELES):
+        if distancia < (1 << (desplazamiento + bits)) or nivel == len(BITS_NIVELES) - 1:
+            # Fuera del alcance del último nivel: se aparca en la ranura más lejana
+            # y se reubica al descender (conserva su vencimiento real)
+            tope = actual + (1 << (desplazamiento + bits)) - 1
+            ranura = (min(vence, tope) >> desplazamiento) & ((1 << bits) - 1)
+            rueda['niveles'][nivel][ranura].append((vence, clave, generacion, dato))
+            rueda['por_nivel'][nivel] += 1
+            return
+        desplazamiento += bits
+
+
+def programar(rueda, momento_ms, clave, dato=None):
+    """
+    Programa (o reprograma) el timer 'clave' para 'momento_ms'.
+    El vencimiento se redondea al tick siguiente: un timer nunca vence
+    antes de 'momento_ms' (a lo sumo un tick después).
+    """
+    rueda['generacion'] += 1
+    generacion = rueda['generacion']
+    rueda['activos'][clave] = generacion
+    _insertar(rueda, -(-momento_ms // rueda['tick_ms']), clave, generacion, dato)
+
+
+def cancelar(rueda, clave):
+    """Cancela el timer 'clave' (si existe)"""
+    rueda['activos'].pop(clave, None)
+
+
+def _descender(rueda, nivel, ranura):
+    """Redistribuye los timers de una ranura superior en los niveles inferiores"""
+    timers = rueda['niveles'][nivel][ranura]
+    if not timers:
+        return
+    rueda['niveles'][nivel][ranura] = []
+    rueda['por_nivel'][nivel] -= len(timers)
+    activos = rueda['activos']
+    for vence, clave, generacion, dato in timers:
+        if activos.get(clave) == generacion:
+            _insertar(rueda, vence, clave, generacion, dato)
+
+
+def avanzar(rueda, ahora_ms):
+    """
+    Procesa todos los ticks hasta 'ahora_ms'.
+    Devuelve [(clave, dato)] de los timers vencidos, en orden.
+    """
+    objetivo = ahora_ms // rueda['tick_ms']
+    vencidos = []
+    activos = rueda['activos']
+    nivel0 = rueda['niveles'][0]
+    mascara0 = (1 << BITS_NIVELES[0]) - 1
+
+    por_nivel = rueda['por_nivel']
+
+    while rueda['actual'] <= objetivo:
+        if not activos:
+            # Sin timers vivos no hay nada que descender ni disparar
+            rueda['actual'] = objetivo + 1
+            break
+
+        # Saltar ticks mientras los niveles inferiores estén vacíos: lo próximo
+        # que puede pasar es el descenso del primer nivel con timers
+        if por_nivel[0] == 0:
+            desplazamiento = 0
+            for nivel, bits in enumerate(BITS_NIVELES):
+                if por_nivel[nivel]:
+                    break
+                desplazamiento += bits
+            paso = 1 << desplazamiento
+            siguiente = -(-rueda['actual'] // paso) * paso
+            if siguiente > objetivo:
+                rueda['actual'] = objetivo + 1
+                break
+            rueda['actual'] = siguiente
+
+        actual = rueda['actual']
+        indice = actual & mascara0
+
+        # Al dar la vuelta el nivel 0, descender desde los niveles superiores
+        if indice == 0:
+            desplazamiento = BITS_NIVELES[0]
+            for nivel in range(1, len(BITS_NIVELES)):
+                bits = BITS_NIVELES[nivel]
+                ranura = (actual >> desplazamiento) & ((1 << bits) - 1)
+                _descender(rueda, nivel, ranura)
+                if ranura != 0:
+                    break
+                desplazamiento += bits
+
+        timers = nivel0[indice]
+        if timers:
+            nivel0[indice] = []
+            por_nivel[0] -= len(timers)
+            for vence, clave, generacion, dato in timers:
+                if activos.get(clave) != generacion:
+                    continue
+                if vence > actual:
+                    # Aparcado por estar fuera de alcance: volver a ubicarlo
+                    _insertar(rueda, vence, clave, generacion, dato)
+                    continue
+                del activos[clave]
+                vencidos.append((clave, dato))
+
+        rueda['actual'] = actual + 1
+
+    return vencidos
+
+
+def pendientes(rueda):
+    """Número de timers activos"""
+    return len(rueda['activos'])
@@ -7,20 +7,21 @@
  El servidor escuchará en http://0.0.0.0:5000
 """
 
-from flask import Flask, request, jsonify
-from datetime import datetime
+from flask import Flask, request, jsonify, g
+from datetime import datetime, timedelta
+from collections import Counter
+import threading
 import json
+import time
 import csv
+import sys
 import os
 
-app = Flask(__name__)
-
-# Almacena el último estado recibido
-ultimo_estado = {}
-historial = []
+from estadisticas import nuevo_acumulado, acumular, resumir
+from rueda_temporizadores import nueva_rueda, programar, avanzar, pendientes
+from bitacora_decisiones import abrir_bitacora, registrar_decision, consultar, obtener_config, resumen_bitacora
 
-# Comando pendiente para enviar al ESP32
-comando_pendiente = None
+app = Flask(__name__)
 
 # =================================================================
 #  SISTEMA ADAPTATIVO INTELIGENTE - "CEREBRO" DEL TRÁFICO
@@ -29,6 +30,7 @@ modo_automatico = False  # Toggle para activar/desactivar
 ultimo_comando_auto = None
 razon_comando = ""
 historial_decisiones = []
+bitacora = abrir_bitacora()  # En memoria; __main__ abre la bitácora durable en DIRECTORIO_BITACORA
 
 # Setpoints actuales del ESP32 (se actualizan con cada mensaje)
 setpoints_actuales = {
@@ -59,17 +61,87 @@ CONFIG_ADAPTATIVO = {
     'umbral_desbalance_alto': 0.70,       # >70% = desbalance fuerte
     'umbral_desbalance_bajo': 0.55,       # <55% = equilibrado (desescalar)
     'registros_desbalance': 10,           # Registros para evaluar (reducido para pruebas)
+    'ventana_desbalance_minutos': 10,     # Registros más viejos expiran de la ventana
     'verde_base_ms': 15000,               # Valor base
     'verde_max_ms': 22000,                # Máximo tiempo verde
     'verde_min_ms': 10000,                # Mínimo tiempo verde
     
     # Control de frecuencia de ajustes
-    'cooldown_ajuste_segundos': 60        # Mínimo 60s entre ajustes
+    'cooldown_ajuste_segundos': 60,       # Mínimo 60s entre ajustes
+    
+    # Temporizadores (evaluación sin esperar a la próxima muestra)
+    'tick_temporizadores_ms': 1000        # Resolución de la rueda de temporizadores
 }
 
 # Último ajuste realizado (para cooldown)
 ultimo_ajuste_timestamp = None
 
+# Trazas por muestra en consola (el gemelo digital las apaga: formatearlas domina su tiempo)
+LOG_DETALLADO = True
+
+def obtener_ahora():
+    """Hora actual del sistema adaptativo (el gemelo digital la reemplaza por su reloj simulado)"""
+    return datetime.now()
+
+# =================================================================
+#  ESTADO PUBLICADO (COPY-ON-WRITE)
+# =================================================================
+# Último estado, historial, comando pendiente y la vista del cerebro
+# viven en una vista inmutable. Los escritores arman una vista nueva
+# bajo lock_publicacion y reemplazan la referencia; los lectores toman
+# 'publicado' una sola vez y leen de ahí, sin lock y sin mezclar
+# muestras. Una vista publicada (y sus dicts/tuplas) no se modifica.
+MAX_HISTORIAL = 100
+lock_publicacion = threading.Lock()
+
+def vista_cerebro():
+    """Copia del estado del cerebro para el dashboard (llamar con lock_cerebro tomado)"""
+    promedio_ratio = 0.5
+    if historial_desbalance:
+        promedio_ratio = sum(h['ratio_d1'] for h in historial_desbalance) / len(historial_desbalance)
+    return {
+        'setpoints': dict(setpoints_actuales),
+        'activaciones_peatonales': tuple(h['timestamp'] for h in historial_peatonal),
+        'promedio_ratio': promedio_ratio,
+        'razon_comando': razon_comando,
+        'decisiones': tuple(historial_decisiones[-5:])
+    }
+
+publicado = {
+    'ultimo_estado': {},         # Última muestra recibida
+    'historial': (),             # Log del dashboard (últimas MAX_HISTORIAL entradas)
+    'comando_pendiente': None,   # Comando manual para enviar al ESP32
+    'modo_automatico': modo_automatico,
+    'cerebro': vista_cerebro(),
+    'datos_analisis': (),
+    'anomalias': (),             # Anomalías recientes (registros que no cambian)
+    'detectores': {}             # {device_id: resumen de sus detectores}
+}
+
+def _nueva_vista(cambios, entradas):
+    """Vista nueva a partir de la actual (llamar con lock_publicacion tomado)"""
+    vista = dict(publicado)
+    vista.update(cambios)
+    if entradas:
+        vista['historial'] = (vista['historial'] + tuple(entradas))[-MAX_HISTORIAL:]
+    return vista
+
+def publicar(cambios=None, entradas=()):
+    """Publica 'cambios' y agrega 'entradas' al historial en un solo paso"""
+    global publicado
+    with lock_publicacion:
+        publicado = _nueva_vista(cambios or {}, entradas)
+
+def tomar_comando_pendiente(timestamp):
+    """Saca el comando manual pendiente (un solo ESP32 lo recibe) y lo registra"""
+    global publicado
+    with lock_publicacion:
+        comando = publicado['comando_pendiente']
+        if comando:
+            publicado = _nueva_vista({'comando_pendiente': None},
+                                     (f"[{timestamp}] 📤 COMANDO ENVIADO: {comando}",))
+    return comando
+
 def actualizar_setpoints(data):
     """Actualiza los setpoints actuales desde los datos del ESP32"""
     global setpoints_actuales
@@ -90,16 +162,19 @@ def registrar_activacion_peatonal(data):
     # Si el contador aumentó, registrar la activación
     if historial_peatonal:
         ultimo = historial_peatonal[-1]
-        if contador > ultimo.get('contador', 0):
-            historial_peatonal.append({
-                'timestamp': datetime.now(),
-                'contador': contador
-            })
-    elif contador > 0:
+        nueva = contador > ultimo.get('contador', 0)
+    else:
+        nueva = contador > 0
+    
+    if nueva:
+        momento = momento_muestra(data)
         historial_peatonal.append({
-            'timestamp': datetime.now(),
+            'timestamp': momento,
             'contador': contador
         })
+        # Re-evaluar cuando esta activación salga de la ventana
+        ventana = timedelta(minutes=CONFIG_ADAPTATIVO['ventana_peatonal_minutos'])
+        programar_evaluacion(obtener_device_id(data), ('peatonal', contador), momento + ventana)
     
     # Mantener solo últimas 50 activaciones
     if len(historial_peatonal) > 50:
@@ -112,17 +187,30 @@ def registrar_desbalance(data):
     d2 = data.get('vehiculos_dir2', 0)
     total = d1 + d2
     
+    # Excluir de la ventana los conteos marcados como anómalos
+    anomalias = data.get('anomalias', {})
+    if 'vehiculos_dir1' in anomalias or 'vehiculos_dir2' in anomalias:
+        if LOG_DETALLADO:
+            print(f"🚨 Conteo descartado por anomalía: D1={d1}, D2={d2}")
+        return
+    
     if total > 0:
         ratio_d1 = d1 / total
-        historial_desbalance.append({
-            'timestamp': datetime.now(),
+        # Las muestras tardías se ubican en su posición temporal
+        insertar_ordenado(historial_desbalance, {
+            'timestamp': momento_muestra(data),
             'ratio_d1': ratio_d1,
             'd1': d1,
             'd2': d2
-        })
-        print(f"📊 Registrado: D1={d1}, D2={d2}, Ratio D1={ratio_d1*100:.1f}% | Historial: {len(historial_desbalance)} registros")
+        }, 'timestamp')
+        if LOG_DETALLADO:
+            print(f"📊 Registrado: D1={d1}, D2={d2}, Ratio D1={ratio_d1*100:.1f}% | Historial: {len(historial_desbalance)} registros")
+        # Re-evaluar cuando expire el registro más reciente (reemplaza el timer anterior)
+        ventana = timedelta(minutes=CONFIG_ADAPTATIVO['ventana_desbalance_minutos'])
+        programar_evaluacion(obtener_device_id(data), 'desbalance', historial_desbalance[-1]['timestamp'] + ventana)
     else:
-        print(f"⚠️ Sin vehículos: D1={d1}, D2={d2}")
+        if LOG_DETALLADO:
+            print(f"⚠️ Sin vehículos: D1={d1}, D2={d2}")
     
     # Mantener solo últimos N registros
     max_registros = CONFIG_ADAPTATIVO['registros_desbalance']
@@ -134,25 +222,48 @@ def analizar_y_decidir(data):
     🧠 CEREBRO ADAPTATIVO: Analiza patrones históricos y ajusta setpoints.
     Usa porcentajes para escalar y desescalar según las condiciones.
     """
-    global ultimo_comando_auto, razon_comando, historial_decisiones, ultimo_ajuste_timestamp
-    
     if not modo_automatico:
         return None, None
     
-    # Actualizar datos
-    actualizar_setpoints(data)
-    registrar_activacion_peatonal(data)
-    registrar_desbalance(data)
+    with lock_cerebro:
+        # Actualizar datos (una muestra tardía no sobrescribe setpoints más recientes)
+        if not data.get('tardio'):
+            actualizar_setpoints(data)
+        registrar_activacion_peatonal(data)
+        registrar_desbalance(data)
+        
+        return evaluar_reglas(obtener_device_id(data))
+
+def evaluar_reglas(device_id):
+    """
+    Aplica las reglas sobre el estado actual. La llaman la ingesta y los
+    temporizadores (cooldown vencido, ventanas que expiran), así que no
+    depende de que llegue una muestra nueva.
+    """
+    global ultimo_comando_auto, razon_comando, historial_decisiones, ultimo_ajuste_timestamp
+    
+    ahora = obtener_ahora()
+    
+    # Expirar registros de desbalance fuera de la ventana
+    limite = ahora - timedelta(minutes=CONFIG_ADAPTATIVO['ventana_desbalance_minutos'])
+    while historial_desbalance and historial_desbalance[0]['timestamp'] <= limite:
+        historial_desbalance.pop(0)
     
     # Verificar cooldown entre ajustes
-    ahora = datetime.now()
     if ultimo_ajuste_timestamp:
         segundos_desde_ajuste = (ahora - ultimo_ajuste_timestamp).total_seconds()
         if segundos_desde_ajuste < CONFIG_ADAPTATIVO['cooldown_ajuste_segundos']:
+            # Asegurar la re-evaluación al vencer el cooldown (si un timer disparó
+            # antes de tiempo, sin esto nadie vuelve a evaluar hasta la próxima muestra)
+            programar_evaluacion(device_id, 'cooldown', ultimo_ajuste_timestamp +
+                                 timedelta(seconds=CONFIG_ADAPTATIVO['cooldown_ajuste_segundos']))
             return None, None
     
     comando = None
     razon = ""
+    regla = None              # Para la bitácora de decisiones
+    valor_anterior = None
+    promedio_ratio_d1 = None
     porcentaje = CONFIG_ADAPTATIVO['porcentaje_ajuste']
     
     # =========================================================
@@ -160,10 +271,8 @@ def analizar_y_decidir(data):
     # =========================================================
     ventana_minutos = CONFIG_ADAPTATIVO['ventana_peatonal_minutos']
     
-    activaciones_recientes = [
-        h for h in historial_peatonal 
-        if (ahora - h['timestamp']).total_seconds() < ventana_minutos * 60
-    ]
+    inicio_ventana = ahora - timedelta(minutes=ventana_minutos)
+    activaciones_recientes = [h for h in historial_peatonal if h['timestamp'] > inicio_ventana]
     num_activaciones = len(activaciones_recientes)
     
     sp_peatonal = setpoints_actuales['sp_peatonal']
@@ -174,6 +283,7 @@ def analizar_y_decidir(data):
             incremento = int(sp_peatonal * porcentaje)
             nuevo_valor = min(sp_peatonal + incremento, CONFIG_ADAPTATIVO['peatonal_max_ms'])
             comando = f"AJUSTAR:SP_PEATONAL:{nuevo_valor}"
+            regla, valor_anterior = 'peatonal_frecuente', sp_peatonal
             razon = f"📈 Peatonal frecuente ({num_activaciones} en {ventana_minutos}min) → +{porcentaje*100:.0f}%: {sp_peatonal/1000:.1f}s → {nuevo_valor/1000:.1f}s"
     
     # DESESCALAR: Pocas activaciones → reducir tiempo (volver al base)
@@ -183,6 +293,7 @@ def analizar_y_decidir(data):
             nuevo_valor = max(sp_peatonal - decremento, CONFIG_ADAPTATIVO['peatonal_min_ms'])
             if nuevo_valor < sp_peatonal:  # Solo si realmente cambia
                 comando = f"AJUSTAR:SP_PEATONAL:{nuevo_valor}"
+                regla, valor_anterior = 'peatonal_bajo', sp_peatonal
                 razon = f"📉 Peatonal bajo ({num_activaciones} en {ventana_minutos}min) → -{porcentaje*100:.0f}%: {sp_peatonal/1000:.1f}s → {nuevo_valor/1000:.1f}s"
     
     # =========================================================
@@ -191,7 +302,8 @@ def analizar_y_decidir(data):
     registros_necesarios = CONFIG_ADAPTATIVO['registros_desbalance']
     registros_actuales = len(historial_desbalance)
     
-    print(f"🔍 Desbalance: {registros_actuales}/{registros_necesarios} registros")
+    if LOG_DETALLADO:
+        print(f"🔍 Desbalance: {registros_actuales}/{registros_necesarios} registros")
     
     if not comando and registros_actuales >= registros_necesarios:
         promedio_ratio_d1 = sum(h['ratio_d1'] for h in historial_desbalance) / len(historial_desbalance)
@@ -200,7 +312,8 @@ def analizar_y_decidir(data):
         umbral_alto = CONFIG_ADAPTATIVO['umbral_desbalance_alto']
         umbral_bajo = CONFIG_ADAPTATIVO['umbral_desbalance_bajo']
         
-        print(f"🔍 Ratio D1: {promedio_ratio_d1*100:.1f}% | Umbral alto: >{umbral_alto*100:.0f}% | SP Verde: {sp_verde}ms")
+        if LOG_DETALLADO:
+            print(f"🔍 Ratio D1: {promedio_ratio_d1*100:.1f}% | Umbral alto: >{umbral_alto*100:.0f}% | SP Verde: {sp_verde}ms")
         
         # ESCALAR: Desbalance fuerte → aumentar tiempo verde
         # D1 domina (>70%) o D2 domina (D1 < 30%)
@@ -208,29 +321,50 @@ def analizar_y_decidir(data):
             direccion = "D1" if promedio_ratio_d1 > 0.5 else "D2"
             pct_dominante = max(promedio_ratio_d1, 1 - promedio_ratio_d1) * 100
             
-            print(f"⚠️ DESBALANCE DETECTADO: {direccion} domina con {pct_dominante:.0f}%")
+            if LOG_DETALLADO:
+                print(f"⚠️ DESBALANCE DETECTADO: {direccion} domina con {pct_dominante:.0f}%")
             
             if sp_verde < CONFIG_ADAPTATIVO['verde_max_ms']:
                 incremento = int(sp_verde * porcentaje)
                 nuevo_valor = min(sp_verde + incremento, CONFIG_ADAPTATIVO['verde_max_ms'])
                 comando = f"AJUSTAR:SP_VERDE_PESADO_MAX:{nuevo_valor}"
+                regla, valor_anterior = 'desbalance', sp_verde
                 razon = f"📈 {direccion} domina ({pct_dominante:.0f}%) → +{porcentaje*100:.0f}%: {sp_verde/1000:.1f}s → {nuevo_valor/1000:.1f}s"
-                print(f"✅ COMANDO GENERADO: {comando}")
+                if LOG_DETALLADO:
+                    print(f"✅ COMANDO GENERADO: {comando}")
             else:
-                print(f"⚠️ No se ajusta: ya en máximo ({sp_verde}ms >= {CONFIG_ADAPTATIVO['verde_max_ms']}ms)")
+                if LOG_DETALLADO:
+                    print(f"⚠️ No se ajusta: ya en máximo ({sp_verde}ms >= {CONFIG_ADAPTATIVO['verde_max_ms']}ms)")
         
         # DESESCALAR: Tráfico equilibrado (entre 45% y 55%) → reducir tiempo verde
         elif (1 - umbral_bajo) <= promedio_ratio_d1 <= umbral_bajo:
-            print(f"📊 Tráfico equilibrado: {promedio_ratio_d1*100:.1f}%")
+            if LOG_DETALLADO:
+                print(f"📊 Tráfico equilibrado: {promedio_ratio_d1*100:.1f}%")
             if sp_verde > CONFIG_ADAPTATIVO['verde_min_ms']:
                 decremento = int(sp_verde * porcentaje)
                 nuevo_valor = max(sp_verde - decremento, CONFIG_ADAPTATIVO['verde_min_ms'])
                 if nuevo_valor < sp_verde:
                     comando = f"AJUSTAR:SP_VERDE_PESADO_MAX:{nuevo_valor}"
+                    regla, valor_anterior = 'equilibrado', sp_verde
                     razon = f"📉 Tráfico equilibrado ({promedio_ratio_d1*100:.0f}%/{(1-promedio_ratio_d1)*100:.0f}%) → -{porcentaje*100:.0f}%: {sp_verde/1000:.1f}s → {nuevo_valor/1000:.1f}s"
-                    print(f"✅ COMANDO GENERADO: {comando}")
+                    if LOG_DETALLADO:
+                        print(f"✅ COMANDO GENERADO: {comando}")
         else:
-            print(f"📊 Sin acción: ratio {promedio_ratio_d1*100:.1f}% no cumple umbrales")
+            if LOG_DETALLADO:
+                print(f"📊 Sin acción: ratio {promedio_ratio_d1*100:.1f}% no cumple umbrales")
+    
+    # =========================================================
+    # REGLA 3: Sin tráfico en la ventana → volver al verde base
+    # =========================================================
+    elif not comando and registros_actuales == 0:
+        sp_verde = setpoints_actuales['sp_verde_pesado_max']
+        base = CONFIG_ADAPTATIVO['verde_base_ms']
+        if sp_verde > base:
+            decremento = int(sp_verde * porcentaje)
+            nuevo_valor = max(sp_verde - decremento, base)
+            comando = f"AJUSTAR:SP_VERDE_PESADO_MAX:{nuevo_valor}"
+            regla, valor_anterior = 'sin_trafico', sp_verde
+            razon = f"💤 Sin tráfico en {CONFIG_ADAPTATIVO['ventana_desbalance_minutos']}min → -{porcentaje*100:.0f}%: {sp_verde/1000:.1f}s → {nuevo_valor/1000:.1f}s"
     
     # Evitar enviar el mismo comando repetidamente
     if comando and comando == ultimo_comando_auto:
@@ -240,6 +374,13 @@ def analizar_y_decidir(data):
         ultimo_comando_auto = comando
         razon_comando = razon
         ultimo_ajuste_timestamp = ahora  # Registrar para cooldown
+        programar_evaluacion(device_id, 'cooldown', ahora + timedelta(seconds=CONFIG_ADAPTATIVO['cooldown_ajuste_segundos']))
+        
+        # Bitácora durable con las entradas de la decisión (la lista de abajo es solo para el dashboard)
+        _, parametro, nuevo_valor = comando.split(':')
+        registrar_decision(bitacora, ahora.timestamp() * 1000, device_id, parametro, regla,
+                           valor_anterior, int(nuevo_valor), num_activaciones, registros_actuales,
+                           promedio_ratio_d1, CONFIG_ADAPTATIVO)
         
         # Guardar en historial de decisiones
         historial_decisiones.append({
@@ -252,12 +393,81 @@ def analizar_y_decidir(data):
     
     return comando, razon
 
+# =================================================================
+#  TEMPORIZADORES - EVALUACIÓN SIN ESPERAR A LA INGESTA
+# =================================================================
+# Cada dispositivo programa sus propios timers (cooldown, expiración de
+# ventanas) en una rueda jerárquica: programar/cancelar es O(1) y un
+# tick solo toca los timers que vencen, no todos los dispositivos.
+rueda = nueva_rueda(CONFIG_ADAPTATIVO['tick_temporizadores_ms'], int(time.time() * 1000))
+lock_cerebro = threading.Lock()  # Serializa ingesta y temporizadores sobre el estado del cerebro
+comandos_temporizador = {}       # {device_id: comando} decidido por un timer, se entrega en la próxima respuesta
+estadisticas_temporizadores = {'vencidos': 0, 'evaluaciones': 0, 'comandos': 0}
+
+def programar_evaluacion(device_id, motivo, momento):
+    """Programa una re-evaluación del dispositivo en 'momento' (reemplaza la anterior del mismo motivo)"""
+    programar(rueda, int(momento.timestamp() * 1000), (device_id, motivo))
+
+def procesar_temporizadores():
+    """Dispara los timers vencidos y evalúa las reglas una vez por dispositivo"""
+    with lock_cerebro:
+        vencidos = avanzar(rueda, int(obtener_ahora().timestamp() * 1000))
+        if not vencidos:
+            return
+        estadisticas_temporizadores['vencidos'] += len(vencidos)
+        if not modo_automatico:
+            return
+        
+        for device_id in dict.fromkeys(clave[0] for clave, _ in vencidos):
+            estadisticas_temporizadores['evaluaciones'] += 1
+            comando, razon = evaluar_reglas(device_id)
+            if comando:
+                estadisticas_temporizadores['comandos'] += 1
+                comandos_temporizador[device_id] = comando
+                print(f"⏰ Temporizador [{device_id}]: {razon}")
+        publicar({'cerebro': vista_cerebro()})
+
+def hilo_temporizadores():
+    """Avanza la rueda una vez por tick"""
+    intervalo = CONFIG_ADAPTATIVO['tick_temporizadores_ms'] / 1000
+    while True:
+        time.sleep(intervalo)
+        try:
+            procesar_temporizadores()
+        except Exception as e:
+            print(f"❌ Error en temporizadores: {e}")
+
+def iniciar_temporizadores():
+    """Arranca el hilo de la rueda (solo desde el servidor, no al importar el módulo)"""
+    threading.Thread(target=hilo_temporizadores, daemon=True).start()
+
+def resumen_temporizadores():
+    """Estado de la rueda para el endpoint de diagnóstico"""
+    return {
+        'pendientes': pendientes(rueda),
+        'tick_ms': rueda['tick_ms'],
+        'comandos_pendientes': dict(comandos_temporizador),
+        **estadisticas_temporizadores
+    }
+
 # Archivo CSV para historial
 CSV_FILE = "traffic_data.csv"
-CSV_COLUMNS = ["timestamp", "estado", "fase", "vehiculos_dir1", "vehiculos_dir2", "ldr1", "ldr2", "co2", "wifi_rssi"]
+
+# Bitácora de decisiones (append-only, ver bitacora_decisiones.py)
+DIRECTORIO_BITACORA = "bitacora"
+MAX_LIMITE_DECISIONES = 1000  # Tope de registros por consulta a /api/decisions
+CSV_COLUMNS = ["timestamp", "estado", "fase", "vehiculos_dir1", "vehiculos_dir2", "ldr1", "ldr2", "co2", "wifi_rssi", "anomalias"]
 
 def inicializar_csv():
     """Crea el archivo CSV con encabezados si no existe"""
+    if os.path.exists(CSV_FILE):
+        # Un archivo con columnas viejas se archiva: las filas nuevas no coincidirían con su encabezado
+        with open(CSV_FILE, newline='', encoding='utf-8') as f:
+            encabezado = next(csv.reader(f), [])
+        if encabezado != CSV_COLUMNS:
+            archivado = f"{os.path.splitext(CSV_FILE)[0]}_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
+            os.rename(CSV_FILE, archivado)
+            print(f"📁 {CSV_FILE} tenía otras columnas, archivado como {archivado}")
     if not os.path.exists(CSV_FILE):
         with open(CSV_FILE, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
@@ -280,21 +490,513 @@ def guardar_en_csv(data):
                 data.get('ldr1', 0),
                 data.get('ldr2', 0),
                 data.get('co2', 0),
-                data.get('wifi_rssi', 0)
+                data.get('wifi_rssi', 0),
+                ';'.join(data.get('anomalias') or ())   # Señales anómalas (vacío = muestra válida)
             ]
             writer.writerow(row)
     except Exception as e:
         print(f"❌ Error guardando CSV: {e}")
 
+# =================================================================
+#  DETECCIÓN DE ANOMALÍAS EN SENSORES (streaming, memoria constante)
+# =================================================================
+# Identificador por defecto cuando el ESP32 no envía 'device_id'
+DEVICE_ID_DEFAULT = "esp32-gen2"
+
+CONFIG_ANOMALIAS = {
+    'z_umbral': 4.0,                      # Desviaciones respecto al nivel EWMA (si la señal no define otro)
+    'alpha_ewma': 0.2,                    # Peso de la muestra nueva en la EWMA
+    'muestras_calentamiento': 12,         # Muestras antes de evaluar picos (~1 min)
+    'max_consecutivas': 12,               # Tras N anomalías seguidas se acepta el nuevo nivel
+    'max_registros': 50,                  # Anomalías recientes para dashboard/API
+
+    # Límites por señal. 'delta_max': salto máximo entre muestras,
+    # 'desv_min': piso de la desviación (evita z infinito en señales planas),
+    # 'repeticiones_max': muestras idénticas (≠0) antes de marcar "atascado",
+    # 'z_umbral': umbral propio, 'reinicio': valor al que el contador vuelve
+    # cada 60s en el ESP32 (diente de sierra, nunca es un pico)
+    'senales': {
+        'vehiculos_dir1': {'min': 0, 'max': 200, 'delta_max': 40, 'desv_min': 4.0, 'repeticiones_max': 24,
+                           'z_umbral': 6.0, 'reinicio': 0},
+        'vehiculos_dir2': {'min': 0, 'max': 200, 'delta_max': 40, 'desv_min': 4.0, 'repeticiones_max': 24,
+                           'z_umbral': 6.0, 'reinicio': 0},
+        'ldr1': {'min': 1, 'max': 4094, 'delta_max': None, 'desv_min': 50.0, 'repeticiones_max': None},
+        'ldr2': {'min': 1, 'max': 4094, 'delta_max': None, 'desv_min': 50.0, 'repeticiones_max': None},
+        'co2': {'min': 0, 'max': 4094, 'delta_max': 800, 'desv_min': 50.0, 'repeticiones_max': None,
+                'z_umbral': 6.0},
+    }
+}
+
+# Estado de los detectores: {device_id: {señal: estado}}
+detectores_anomalias = {}
+historial_anomalias = []
+lock_anomalias = threading.Lock()  # Requests concurrentes actualizan los detectores y publican su resumen
+
+def obtener_device_id(data):
+    """Devuelve el identificador del dispositivo que envió los datos"""
+    return str(data.get('device_id') or DEVICE_ID_DEFAULT)
+
+def nuevo_detector():
+    """Estado inicial de un detector (EWMA + varianza exponencial + repeticiones)"""
+    return {
+        'n': 0,             # Muestras aceptadas
+        'ewma': None,       # Nivel reciente
+        'varianza': 0.0,    # Varianza exponencial con el mismo alpha (olvida como la EWMA)
+        'anterior': None,   # Última muestra recibida
+        'ultimo_valido': None,  # Última muestra aceptada (referencia de saltos)
+        'repeticiones': 0,  # Muestras idénticas seguidas
+        'consecutivas': 0,  # Anomalías seguidas
+        'anomalias': 0      # Total de anomalías marcadas
+    }
+
+def evaluar_muestra(detector, valor, limites):
+    """
+    Evalúa una muestra y actualiza el detector en O(1).
+    Devuelve el motivo de la anomalía o None si la muestra es válida.
+    """
+    motivo = None
+    cambio_nivel = False  # Solo saltos y picos pueden ser un cambio de nivel legítimo
+
+    # 1. Valor fuera de rango / saturado
+    if valor < limites['min'] or valor > limites['max']:
+        motivo = f"fuera de rango ({valor})"
+
+    # 2. Valor atascado (contadores que deberían reiniciarse cada 60s)
+    if valor == detector['anterior'] and valor != 0:
+        repeticiones = detector['repeticiones'] = detector['repeticiones'] + 1
+        repeticiones_max = limites['repeticiones_max']
+        if motivo is None and repeticiones_max and repeticiones >= repeticiones_max:
+            motivo = f"atascado en {valor} ({repeticiones + 1} muestras)"
+    else:
+        detector['repeticiones'] = 0
+    detector['anterior'] = valor
+
+    # El valor de reinicio del contador nunca es un salto ni un pico
+    if motivo is None and valor != limites.get('reinicio'):
+        # 3. Tasa de cambio respecto a la última muestra válida
+        delta_max = limites['delta_max']
+        ultimo_valido = detector['ultimo_valido']
+        if delta_max is not None and ultimo_valido is not None and abs(valor - ultimo_valido) > delta_max:
+            motivo = f"salto {ultimo_valido}→{valor}"
+            cambio_nivel = True
+
+        # 4. Pico respecto al nivel EWMA, normalizado por la desviación de la misma ventana
+        elif detector['n'] >= CONFIG_ANOMALIAS['muestras_calentamiento']:
+            desviacion = max(detector['varianza'] ** 0.5, limites['desv_min'])
+            distancia = abs(valor - detector['ewma'])
+            if distancia > limites.get('z_umbral', CONFIG_ANOMALIAS['z_umbral']) * desviacion:
+                motivo = f"pico z={distancia / desviacion:.1f}"
+                cambio_nivel = True
+
+    if motivo is not None:
+        detector['anomalias'] += 1
+        detector['consecutivas'] += 1
+        # Cambio de nivel sostenido: reiniciar estadísticas y aceptar el nuevo nivel
+        if not cambio_nivel or detector['consecutivas'] < CONFIG_ANOMALIAS['max_consecutivas']:
+            return motivo
+        detector.update(n=0, ewma=None, varianza=0.0)
+
+    # Muestra aceptada: actualizar EWMA y varianza exponencial
+    detector['consecutivas'] = 0
+    detector['ultimo_valido'] = valor
+    detector['n'] += 1
+    ewma = detector['ewma']
+    if ewma is None:
+        detector['ewma'] = float(valor)
+    else:
+        alpha = CONFIG_ANOMALIAS['alpha_ewma']
+        diferencia = valor - ewma
+        incremento = alpha * diferencia
+        detector['ewma'] = ewma + incremento
+        detector['varianza'] = (1 - alpha) * (detector['varianza'] + diferencia * incremento)
+    return motivo
+
+def detectar_anomalias(data):
+    """
+    Pasa cada señal del dispositivo por su detector.
+    Devuelve {señal: motivo} solo con las señales anómalas.
+    """
+    device_id = obtener_device_id(data)
+    anomalias = {}
+
+    with lock_anomalias:
+        detectores = detectores_anomalias.setdefault(device_id, {})
+        for senal, limites in CONFIG_ANOMALIAS['senales'].items():
+            valor = data.get(senal)
+            if not isinstance(valor, (int, float)):
+                continue
+            detector = detectores.get(senal)
+            if detector is None:
+                detector = detectores[senal] = nuevo_detector()
+            motivo = evaluar_muestra(detector, valor, limites)
+            if motivo:
+                anomalias[senal] = motivo
+
+        if anomalias:
+            historial_anomalias.append({
+                'timestamp': data.get('timestamp'),
+                'device_id': device_id,
+                'anomalias': anomalias
+            })
+            if len(historial_anomalias) > CONFIG_ANOMALIAS['max_registros']:
+                historial_anomalias.pop(0)
+
+    if anomalias and LOG_DETALLADO:
+        print(f"🚨 Anomalía en {device_id}: {anomalias}")
+
+    return anomalias
+
+def resumen_dispositivo(detectores):
+    """Resumen serializable de los detectores de un dispositivo (llamar con lock_anomalias tomado)"""
+    return {
+        senal: {
+            'muestras': d['n'],
+            'ewma': round(d['ewma'], 2) if d['ewma'] is not None else None,
+            'desviacion': round(d['varianza'] ** 0.5, 2),
+            'anomalias': d['anomalias']
+        }
+        for senal, d in detectores.items()
+    }
+
+def publicar_anomalias(device_id):
+    """
+    Publica el historial de anomalías y el resumen del dispositivo recién evaluado.
+    Se lee y publica sin soltar lock_anomalias: la última publicación siempre
+    refleja el estado más nuevo. El dashboard y la API leen 'publicado' sin locks.
+    """
+    global publicado
+    with lock_anomalias:
+        anomalias = tuple(historial_anomalias)
+        resumen = resumen_dispositivo(detectores_anomalias.get(device_id, {}))
+        with lock_publicacion:
+            detectores = dict(publicado['detectores'])
+            detectores[device_id] = resumen
+            publicado = _nueva_vista({'anomalias': anomalias, 'detectores': detectores}, ())
+
+# =================================================================
+#  INGESTA IDEMPOTENTE (números de secuencia + deduplicación)
+# =================================================================
+CONFIG_INGESTA = {
+    'ventana_secuencia': 64,              # Bits del bitmap deslizante por dispositivo
+    'max_desfase_segundos': 3600          # Desfase máximo aceptado del reloj del ESP32
+}
+
+# Estado de deduplicación: {device_id: {'max_seq', 'mascara', 'boot_id', 'ultima_respuesta'}}
+secuencias_dispositivos = {}
+lock_secuencias = threading.Lock()  # Reintentos concurrentes del mismo dispositivo
+
+def _es_reinicio(estado, seq, boot_id):
+    """
+    El ESP32 reinicia 'seq' en 1 en cada arranque y envía un 'boot_id' nuevo.
+    Sin 'boot_id' (firmware anterior) solo se reconoce un reinicio por el salto
+    de secuencia: una 'seq' baja muy por detrás de la máxima vista.
+    """
+    if boot_id is not None:
+        return estado['boot_id'] != boot_id
+    ventana = CONFIG_INGESTA['ventana_secuencia']
+    return estado['max_seq'] - seq >= ventana and seq < ventana
+
+def _clasificar(estado, seq, boot_id):
+    """Clasificación de 'seq' según el estado del dispositivo (llamar con lock_secuencias tomado)"""
+    if estado is None or _es_reinicio(estado, seq, boot_id):
+        return 'nuevo'
+
+    atraso = estado['max_seq'] - seq
+    if atraso < 0:
+        return 'nuevo'
+    if atraso >= CONFIG_INGESTA['ventana_secuencia']:
+        return 'antiguo'
+    return 'duplicado' if estado['mascara'] & (1 << atraso) else 'tardio'
+
+def ver_secuencia(device_id, seq, boot_id=None):
+    """
+    Clasifica 'seq' sin registrarla: 'nuevo', 'tardio', 'duplicado' o 'antiguo'.
+    Permite responder a un reintento antes del control de admisión.
+    """
+    with lock_secuencias:
+        return _clasificar(secuencias_dispositivos.get(device_id), seq, boot_id)
+
+def clasificar_secuencia(device_id, seq, boot_id=None):
+    """
+    Registra 'seq' en el bitmap deslizante del dispositivo (memoria fija).
+    Devuelve 'nuevo', 'tardio' (fuera de orden, no visto), 'duplicado' o 'antiguo'.
+    El bit i de la máscara indica que se vio la secuencia max_seq - i.
+    """
+    ventana = CONFIG_INGESTA['ventana_secuencia']
+    with lock_secuencias:
+        estado = secuencias_dispositivos.get(device_id)
+        clasificacion = _clasificar(estado, seq, boot_id)
+
+        if estado is None:
+            secuencias_dispositivos[device_id] = {'max_seq': seq, 'mascara': 1, 'boot_id': boot_id,
+                                                  'ultima_respuesta': None}
+        elif _es_reinicio(estado, seq, boot_id):
+            print(f"🔄 {device_id} reinició su secuencia ({estado['max_seq']} → {seq})")
+            estado.update(max_seq=seq, mascara=1, boot_id=boot_id, ultima_respuesta=None)
+        elif clasificacion == 'nuevo':
+            # Secuencia más reciente: desplazar la ventana
+            desplazamiento = seq - estado['max_seq']
+            estado['mascara'] = ((estado['mascara'] << desplazamiento) | 1) & ((1 << ventana) - 1)
+            estado['max_seq'] = seq
+        elif clasificacion == 'tardio':
+            estado['mascara'] |= 1 << (estado['max_seq'] - seq)
+    return clasificacion
+
+def timestamp_muestra(data):
+    """
+    Usa el timestamp del dispositivo ('device_ts', epoch en segundos) si es
+    plausible; si no, la hora del servidor.
+    """
+    ahora = obtener_ahora()
+    device_ts = data.get('device_ts')
+    if isinstance(device_ts, (int, float)):
+        try:
+            momento = datetime.fromtimestamp(device_ts)
+        except (OverflowError, OSError, ValueError):
+            momento = None
+        if momento and abs((ahora - momento).total_seconds()) <= CONFIG_INGESTA['max_desfase_segundos']:
+            return momento.strftime('%Y-%m-%d %H:%M:%S')
+    return ahora.strftime('%Y-%m-%d %H:%M:%S')
+
+def momento_muestra(data):
+    """Convierte el timestamp de la muestra en datetime (para las ventanas)"""
+    try:
+        # fromisoformat acepta 'YYYY-MM-DD HH:MM:SS' y es mucho más rápido que strptime
+        return datetime.fromisoformat(data['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return obtener_ahora()
+
+def insertar_ordenado(lista, registro, clave):
+    """Inserta manteniendo orden temporal; las muestras en orden llegan al final"""
+    i = len(lista)
+    while i > 0 and lista[i - 1][clave] > registro[clave]:
+        i -= 1
+    lista.insert(i, registro)
+
+# =================================================================
+#  PERFILADO: TIEMPOS POR ETAPA Y PERFILADOR POR MUESTREO
+# =================================================================
+CONFIG_PERFILADO = {
+    'cabecera_siempre': False,            # Si False, solo con la cabecera X-Debug-Timing
+    'max_segundos_perfil': 300,           # Duración máxima de una sesión de perfilado
+    'intervalo_muestreo_ms': 5,           # Periodo de muestreo de las pilas
+    'max_profundidad_pila': 64,
+    'solo_localhost': True                # Endpoints de administración solo desde esta máquina
+}
+
+# Acumulados por etapa: {etapa: {'n', 'total_ms', 'max_ms'}}
+tiempos_etapas = {}
+lock_tiempos = threading.Lock()
+
+# Sesión de perfilado por muestreo (hilo activo solo mientras dura)
+perfil_actual = {
+    'activo': False,
+    'inicio': None,
+    'fin': None,
+    'muestras': 0,
+    'pilas': Counter(),
+    'detener': threading.Event()
+}
+lock_perfilado = threading.Lock()  # Arranque/parada de la sesión y lectura de las pilas
+
+def iniciar_cronometro():
+    """Cronómetro de etapas para una petición"""
+    return {'inicio': time.perf_counter(), 'ultimo': time.perf_counter(), 'etapas': []}
+
+def marcar_etapa(cronometro, etapa):
+    """Registra la duración de la etapa que acaba de terminar"""
+    ahora = time.perf_counter()
+    cronometro['etapas'].append((etapa, (ahora - cronometro['ultimo']) * 1000))
+    cronometro['ultimo'] = ahora
+
+def registrar_tiempos(cronometro):
+    """Acumula los tiempos de la petición en las estadísticas por etapa"""
+    total_ms = (time.perf_counter() - cronometro['inicio']) * 1000
+    with lock_tiempos:
+        for etapa, ms in cronometro['etapas'] + [('total', total_ms)]:
+            acumulado = tiempos_etapas.get(etapa)
+            if acumulado is None:
+                acumulado = tiempos_etapas[etapa] = {'n': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            acumulado['n'] += 1
+            acumulado['total_ms'] += ms
+            if ms > acumulado['max_ms']:
+                acumulado['max_ms'] = ms
+    return total_ms
+
+def responder_con_tiempos(cronometro, cuerpo, codigo):
+    """Genera la respuesta JSON y, si se pidió, la cabecera Server-Timing"""
+    total_ms = registrar_tiempos(cronometro)
+    respuesta = jsonify(cuerpo)
+    if CONFIG_PERFILADO['cabecera_siempre'] or request.headers.get('X-Debug-Timing'):
+        partes = [f"{etapa};dur={ms:.3f}" for etapa, ms in cronometro['etapas']]
+        partes.append(f"total;dur={total_ms:.3f}")
+        respuesta.headers['Server-Timing'] = ", ".join(partes)
+    return respuesta, codigo
+
+def resumen_tiempos():
+    """Estadísticas por etapa en milisegundos"""
+    with lock_tiempos:
+        return {
+            etapa: {
+                'n': t['n'],
+                'promedio_ms': round(t['total_ms'] / t['n'], 3),
+                'max_ms': round(t['max_ms'], 3),
+                'total_ms': round(t['total_ms'], 3)
+            }
+            for etapa, t in tiempos_etapas.items()
+        }
+
+def muestrear_pilas(segundos, intervalo):
+    """Hilo del perfilador: cuenta las pilas de los demás hilos (formato 'collapsed')"""
+    propio = threading.get_ident()
+    limite = time.monotonic() + segundos
+    profundidad = CONFIG_PERFILADO['max_profundidad_pila']
+    with lock_perfilado:
+        detener = perfil_actual['detener']
+        pilas = perfil_actual['pilas']
+
+    while time.monotonic() < limite and not detener.wait(intervalo):
+        muestra = []
+        for ident, frame in sys._current_frames().items():
+            if ident == propio:
+                continue
+            marcos = []
+            while frame is not None and len(marcos) < profundidad:
+                codigo = frame.f_code
+                marcos.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}")
+                frame = frame.f_back
+            muestra.append(";".join(reversed(marcos)))
+        with lock_perfilado:
+            pilas.update(muestra)
+            perfil_actual['muestras'] += 1
+
+    with lock_perfilado:
+        # Solo la sesión vigente marca el fin
+        if perfil_actual['detener'] is detener:
+            perfil_actual['activo'] = False
+            perfil_actual['fin'] = datetime.now()
+    print(f"🔬 Perfilado finalizado: {perfil_actual['muestras']} muestras")
+
+def iniciar_perfilado(segundos):
+    """Arranca una sesión de perfilado por muestreo durante N segundos"""
+    with lock_perfilado:
+        # Comprobar y marcar en el mismo paso: dos peticiones simultáneas no arrancan dos hilos
+        if perfil_actual['activo']:
+            return False
+        perfil_actual.update(
+            activo=True,
+            inicio=datetime.now(),
+            fin=None,
+            muestras=0,
+            pilas=Counter(),
+            detener=threading.Event()
+        )
+        intervalo = CONFIG_PERFILADO['intervalo_muestreo_ms'] / 1000
+        hilo = threading.Thread(target=muestrear_pilas, args=(segundos, intervalo), daemon=True)
+        hilo.start()
+    print(f"🔬 Perfilado iniciado por {segundos}s")
+    return True
+
+def detener_perfilado():
+    """Pide al hilo de la sesión vigente que termine"""
+    with lock_perfilado:
+        perfil_actual['detener'].set()
+
+def pilas_perfilado():
+    """[(pila, muestras)] de la sesión, de la más frecuente a la menos"""
+    with lock_perfilado:
+        return perfil_actual['pilas'].most_common()
+
+def estado_perfilado():
+    """Resumen serializable de la sesión de perfilado"""
+    with lock_perfilado:
+        return {
+            'activo': perfil_actual['activo'],
+            'inicio': perfil_actual['inicio'].strftime('%Y-%m-%d %H:%M:%S') if perfil_actual['inicio'] else None,
+            'fin': perfil_actual['fin'].strftime('%Y-%m-%d %H:%M:%S') if perfil_actual['fin'] else None,
+            'muestras': perfil_actual['muestras'],
+            'pilas_distintas': len(perfil_actual['pilas'])
+        }
+
+def es_peticion_local():
+    """Los endpoints de administración solo se aceptan desde localhost"""
+    if not CONFIG_PERFILADO['solo_localhost']:
+        return True
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+# =================================================================
+#  CONTROL DE ADMISIÓN Y BACKPRESSURE
+# =================================================================
+CONFIG_ADMISION = {
+    'tokens_por_segundo': 1.0,            # El ESP32 envía cada 5s (0.2/s): margen para reintentos
+    'rafaga': 5,                          # Muestras seguidas permitidas por dispositivo
+    'max_en_proceso': 16,                 # Muestras procesándose a la vez (todos los dispositivos)
+    'retry_after_segundos': 5             # Espera sugerida al ESP32 cuando hay saturación
+}
+
+# Token bucket por dispositivo: {device_id: {'tokens', 'ultimo'}}
+cubetas_dispositivos = {}
+lock_admision = threading.Lock()
+muestras_en_proceso = 0
+estadisticas_admision = {'admitidas': 0, 'limite_dispositivo': 0, 'saturacion': 0}
+
+def admitir_muestra(device_id):
+    """
+    Decide si una muestra entra al procesamiento completo.
+    Devuelve (None, 0) si se admite o (motivo, segundos_para_reintentar).
+    """
+    global muestras_en_proceso
+    ahora = time.monotonic()
+    tasa = CONFIG_ADMISION['tokens_por_segundo']
+    rafaga = CONFIG_ADMISION['rafaga']
+
+    with lock_admision:
+        cubeta = cubetas_dispositivos.get(device_id)
+        if cubeta is None:
+            cubeta = cubetas_dispositivos[device_id] = {'tokens': rafaga, 'ultimo': ahora}
+        cubeta['tokens'] = min(rafaga, cubeta['tokens'] + (ahora - cubeta['ultimo']) * tasa)
+        cubeta['ultimo'] = ahora
+
+        if cubeta['tokens'] < 1:
+            estadisticas_admision['limite_dispositivo'] += 1
+            espera = (1 - cubeta['tokens']) / tasa
+            return 'limite_dispositivo', max(1, int(espera + 0.999))
+
+        if muestras_en_proceso >= CONFIG_ADMISION['max_en_proceso']:
+            estadisticas_admision['saturacion'] += 1
+            return 'saturacion', CONFIG_ADMISION['retry_after_segundos']
+
+        cubeta['tokens'] -= 1
+        muestras_en_proceso += 1
+        estadisticas_admision['admitidas'] += 1
+    return None, 0
+
+def liberar_muestra():
+    """Libera el cupo de una muestra admitida"""
+    global muestras_en_proceso
+    with lock_admision:
+        muestras_en_proceso -= 1
+
+@app.teardown_request
+def liberar_admision(error=None):
+    """Libera el cupo aunque el procesamiento haya fallado"""
+    if g.pop('muestra_admitida', False):
+        liberar_muestra()
+
+def resumen_admision():
+    """Estado del control de admisión"""
+    with lock_admision:
+        return dict(estadisticas_admision, en_proceso=muestras_en_proceso, dispositivos=len(cubetas_dispositivos))
+
 # =================================================================
 #  ANÁLISIS DE DATOS EN TIEMPO REAL
 # =================================================================
-# Almacena datos para estadísticas (últimos 100 registros)
+# Almacena datos para estadísticas (últimos 100 registros, se modifica con lock_cerebro tomado)
 datos_analisis = []
 
 def agregar_dato_analisis(data):
     """Agrega dato para análisis y mantiene solo los últimos 100"""
-    datos_analisis.append({
+    insertar_ordenado(datos_analisis, {
         'timestamp': data.get('timestamp'),
         'estado': data.get('estado'),
         'vehiculos_dir1': data.get('vehiculos_dir1', 0),
@@ -302,73 +1004,32 @@ def agregar_dato_analisis(data):
         'co2': data.get('co2', 0),
         'ldr1': data.get('ldr1', 0),
         'ldr2': data.get('ldr2', 0)
-    })
+    }, 'timestamp')
     if len(datos_analisis) > 100:
         datos_analisis.pop(0)
 
-def calcular_estadisticas():
-    """Calcula estadísticas de los datos recolectados"""
-    if not datos_analisis:
+def calcular_estadisticas(datos=None):
+    """Calcula estadísticas de los datos recolectados (o de una copia publicada)"""
+    if datos is None:
+        datos = datos_analisis
+    if not datos:
         return None
     
-    total_dir1 = sum(d['vehiculos_dir1'] for d in datos_analisis)
-    total_dir2 = sum(d['vehiculos_dir2'] for d in datos_analisis)
-    total_vehiculos = total_dir1 + total_dir2
-    
-    # Promedios
-    n = len(datos_analisis)
-    avg_co2 = sum(d['co2'] for d in datos_analisis) / n
-    avg_luz = sum((d['ldr1'] + d['ldr2']) / 2 for d in datos_analisis) / n
-    
-    # Conteo de estados
-    estados_count = {}
-    for d in datos_analisis:
-        estado = d['estado']
-        estados_count[estado] = estados_count.get(estado, 0) + 1
-    
-    # Estado más frecuente
-    estado_frecuente = max(estados_count, key=estados_count.get) if estados_count else "N/A"
-    
-    # Porcentaje de tráfico por dirección
-    pct_dir1 = (total_dir1 / total_vehiculos * 100) if total_vehiculos > 0 else 50
-    pct_dir2 = (total_dir2 / total_vehiculos * 100) if total_vehiculos > 0 else 50
-    
-    # Dirección dominante
-    if total_dir1 > total_dir2 * 1.2:
-        direccion_dominante = "Dirección 1 (+20%)"
-    elif total_dir2 > total_dir1 * 1.2:
-        direccion_dominante = "Dirección 2 (+20%)"
-    else:
-        direccion_dominante = "Equilibrado"
-    
-    # Recomendación
-    if pct_dir1 > 60:
-        recomendacion = "⚡ Aumentar tiempo verde Dir1"
-    elif pct_dir2 > 60:
-        recomendacion = "⚡ Aumentar tiempo verde Dir2"
-    elif avg_co2 > 400:
-        recomendacion = "🌿 CO2 alto - ciclos largos activos"
-    else:
-        recomendacion = "✅ Sistema balanceado"
-    
-    return {
-        'total_registros': n,
-        'total_vehiculos': total_vehiculos,
-        'total_dir1': total_dir1,
-        'total_dir2': total_dir2,
-        'pct_dir1': round(pct_dir1, 1),
-        'pct_dir2': round(pct_dir2, 1),
-        'avg_co2': round(avg_co2, 1),
-        'avg_luz': round(avg_luz, 1),
-        'estados_count': estados_count,
-        'estado_frecuente': estado_frecuente,
-        'direccion_dominante': direccion_dominante,
-        'recomendacion': recomendacion
-    }
+    acum = nuevo_acumulado()
+    for d in datos:
+        acumular(acum, d['estado'], d['vehiculos_dir1'], d['vehiculos_dir2'], d['co2'], d['ldr1'], d['ldr2'])
+    return resumir(acum)
 
 @app.route('/')
 def index():
     """Página principal con estado actual"""
+    # Una sola lectura de la vista publicada: todo el HTML sale del mismo estado
+    vista = publicado
+    ultimo_estado = vista['ultimo_estado']
+    modo_automatico = vista['modo_automatico']
+    cerebro = vista['cerebro']
+    setpoints = cerebro['setpoints']
+    
     html = """
     <!DOCTYPE html>
     <html>
@@ -478,8 +1139,8 @@ def index():
                 </form>
             </div>
     """
-    if comando_pendiente:
-        html += f'<p style="color: #ffaa00;">⏳ Comando pendiente: {comando_pendiente}</p>'
+    if vista['comando_pendiente']:
+        html += f'<p style="color: #ffaa00;">⏳ Comando pendiente: {vista["comando_pendiente"]}</p>'
     html += "</div>"
     
     # Panel del Sistema Adaptativo Inteligente
@@ -490,14 +1151,13 @@ def index():
     btn_class = "btn btn-red" if modo_automatico else "btn btn-purple"
     
     # Información de setpoints y patrones
+    ahora = obtener_ahora()
     activaciones_recientes = len([
-        h for h in historial_peatonal 
-        if (datetime.now() - h['timestamp']).total_seconds() < CONFIG_ADAPTATIVO['ventana_peatonal_minutos'] * 60
-    ]) if historial_peatonal else 0
+        t for t in cerebro['activaciones_peatonales']
+        if (ahora - t).total_seconds() < CONFIG_ADAPTATIVO['ventana_peatonal_minutos'] * 60
+    ])
     
-    promedio_ratio = 0.5
-    if historial_desbalance:
-        promedio_ratio = sum(h['ratio_d1'] for h in historial_desbalance) / len(historial_desbalance)
+    promedio_ratio = cerebro['promedio_ratio']
     
     html += f"""
         <div class="card {auto_class}">
@@ -517,19 +1177,19 @@ def index():
                 <div style="display: grid; grid-template-columns: repeat(2, 1fr); gap: 10px; margin-top: 10px;">
                     <div style="background: #0f3460; padding: 10px; border-radius: 5px;">
                         <span style="color: #888;">Verde Normal:</span>
-                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints_actuales['sp_verde_normal']/1000:.1f}s</span>
+                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints['sp_verde_normal']/1000:.1f}s</span>
                     </div>
                     <div style="background: #0f3460; padding: 10px; border-radius: 5px;">
                         <span style="color: #888;">Tiempo Peatonal:</span>
-                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints_actuales['sp_peatonal']/1000:.1f}s</span>
+                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints['sp_peatonal']/1000:.1f}s</span>
                     </div>
                     <div style="background: #0f3460; padding: 10px; border-radius: 5px;">
                         <span style="color: #888;">Verde Máx (Pesado):</span>
-                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints_actuales['sp_verde_pesado_max']/1000:.1f}s</span>
+                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints['sp_verde_pesado_max']/1000:.1f}s</span>
                     </div>
                     <div style="background: #0f3460; padding: 10px; border-radius: 5px;">
                         <span style="color: #888;">Verde Mín (Pesado):</span>
-                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints_actuales['sp_verde_pesado_min']/1000:.1f}s</span>
+                        <span style="color: #00d4ff; font-weight: bold;"> {setpoints['sp_verde_pesado_min']/1000:.1f}s</span>
                     </div>
                 </div>
             </div>
@@ -542,7 +1202,11 @@ def index():
                     <li>📉 <strong>Peatonal bajo</strong> (≤{CONFIG_ADAPTATIVO['umbral_peatonal_bajo']} en {CONFIG_ADAPTATIVO['ventana_peatonal_minutos']}min) → <span style="color:#ff6666;">-{CONFIG_ADAPTATIVO['porcentaje_ajuste']*100:.0f}%</span></li>
                     <li>📈 <strong>Desbalance</strong> (&gt;{CONFIG_ADAPTATIVO['umbral_desbalance_alto']*100:.0f}% una dir) → <span style="color:#00ff88;">+{CONFIG_ADAPTATIVO['porcentaje_ajuste']*100:.0f}%</span> verde</li>
                     <li>📉 <strong>Equilibrado</strong> ({CONFIG_ADAPTATIVO['umbral_desbalance_bajo']*100:.0f}%-{(1-CONFIG_ADAPTATIVO['umbral_desbalance_bajo'])*100:.0f}%) → <span style="color:#ff6666;">-{CONFIG_ADAPTATIVO['porcentaje_ajuste']*100:.0f}%</span> verde</li>
+                    <li>💤 <strong>Sin tráfico</strong> (0 registros en {CONFIG_ADAPTATIVO['ventana_desbalance_minutos']}min) → <span style="color:#ff6666;">-{CONFIG_ADAPTATIVO['porcentaje_ajuste']*100:.0f}%</span> verde hasta la base ({CONFIG_ADAPTATIVO['verde_base_ms']/1000:.0f}s)</li>
                 </ul>
+                <div style="font-size: 12px; color: #888;">
+                    Los registros de desbalance expiran tras {CONFIG_ADAPTATIVO['ventana_desbalance_minutos']}min: un temporizador reevalúa aunque no lleguen muestras.
+                </div>
                 <div style="font-size: 12px; color: #888; margin-top: 5px;">
                     Activaciones recientes: <strong>{activaciones_recientes}</strong> | 
                     Balance D1/D2: <strong>{promedio_ratio*100:.0f}%/{(1-promedio_ratio)*100:.0f}%</strong>
@@ -551,23 +1215,23 @@ def index():
     """
     
     # Mostrar última decisión y historial
-    if modo_automatico and razon_comando:
+    if modo_automatico and cerebro['razon_comando']:
         html += f"""
             <div style="background: #0f3460; padding: 10px; border-radius: 5px; margin-bottom: 10px; border-left: 4px solid #00ff88;">
                 <strong>🎯 Última adaptación:</strong><br>
-                <span style="font-size: 13px;">{razon_comando}</span>
+                <span style="font-size: 13px;">{cerebro['razon_comando']}</span>
             </div>
         """
     
-    if historial_decisiones:
+    if cerebro['decisiones']:
         html += "<div><strong>📜 Historial de Adaptaciones:</strong></div>"
-        for decision in reversed(historial_decisiones[-5:]):
+        for decision in reversed(cerebro['decisiones']):
             html += f'<div class="decision-item">[{decision["timestamp"]}] <strong>{decision["comando"]}</strong>: {decision["razon"]}</div>'
     
     html += "</div>"
     
     # Panel de Estadísticas
-    stats = calcular_estadisticas()
+    stats = calcular_estadisticas(vista['datos_analisis'])
     if stats:
         html += f"""
             <div class="card">
@@ -625,22 +1289,36 @@ def index():
             </div>
         """
     
+    # Panel de Anomalías de Sensores
+    anomalias = vista['anomalias']
+    if anomalias:
+        html += """
+            <div class="card">
+                <h2>🚨 Anomalías de Sensores</h2>
+                <p style="font-size: 12px; color: #888;">Muestras excluidas de las ventanas adaptativas</p>
+                <div class="historial">
+        """
+        for item in reversed(anomalias[-10:]):
+            detalle = ", ".join(f"{senal}: {motivo}" for senal, motivo in item['anomalias'].items())
+            html += f'<div class="historial-item">[{item["timestamp"]}] <strong>{item["device_id"]}</strong> → {detalle}</div>'
+        html += "</div></div>"
+    
     # Mostrar historial
-    if historial:
+    if vista['historial']:
         html += """
             <div class="card">
                 <h2>📋 Historial Reciente</h2>
                 <div class="historial">
         """
-        for item in reversed(historial[-20:]):
+        for item in reversed(vista['historial'][-20:]):
             html += f'<div class="historial-item">{item}</div>'
         html += "</div></div>"
     
     # Agregar JavaScript para las gráficas
-    stats = calcular_estadisticas()
+    stats = calcular_estadisticas(vista['datos_analisis'])
     if stats:
         # Preparar datos para gráfica temporal
-        datos_temporales = list(datos_analisis)[-20:]  # Últimos 20 registros
+        datos_temporales = list(vista['datos_analisis'])[-20:]  # Últimos 20 registros
         labels_tiempo = [d.get('timestamp', '')[-8:-3] for d in datos_temporales]  # HH:MM
         valores_d1 = [d.get('vehiculos_dir1', 0) for d in datos_temporales]
         valores_d2 = [d.get('vehiculos_dir2', 0) for d in datos_temporales]
@@ -741,40 +1419,140 @@ def index():
     return html
 
 
+def responder_repetida(cronometro, device_id, seq, clasificacion):
+    """Respuesta a una muestra ya vista ('duplicado') o fuera de la ventana ('antiguo')"""
+    marcar_etapa(cronometro, 'dedup')
+    if clasificacion == 'duplicado':
+        # Reenviar la misma respuesta (el ESP32 pudo perder el comando)
+        print(f"♻️ Muestra duplicada descartada: {device_id} seq={seq}")
+        with lock_secuencias:
+            cache = secuencias_dispositivos[device_id]['ultima_respuesta']
+        if cache and cache['seq'] == seq:
+            return responder_con_tiempos(cronometro, cache['respuesta'], 200)
+        return responder_con_tiempos(cronometro, {"status": "duplicate", "seq": seq}, 200)
+    print(f"⌛ Muestra fuera de ventana descartada: {device_id} seq={seq}")
+    return responder_con_tiempos(cronometro, {"status": "stale", "seq": seq}, 200)
+
+
+def responder_descartada(cronometro, data, device_id, motivo, reintentar_en, clasificacion):
+    """
+    Respuesta barata para una muestra no admitida: sin CSV ni decisiones.
+    Solo actualiza el estado visible si la muestra es más nueva que la mostrada
+    (nunca con una tardía) y entrega el comando pendiente o el de un temporizador.
+    """
+    global publicado
+    timestamp = obtener_ahora().strftime('%Y-%m-%d %H:%M:%S')
+    with lock_publicacion:
+        ultimo_estado = publicado['ultimo_estado']
+        seq, seq_mostrada = data.get('seq'), ultimo_estado.get('seq')
+        # Tras un reinicio (otro boot_id) la secuencia vuelve a empezar: no se compara
+        mismo_arranque = data.get('boot_id') == ultimo_estado.get('boot_id')
+        mas_reciente = clasificacion == 'nuevo' and not (
+            mismo_arranque and isinstance(seq, int) and isinstance(seq_mostrada, int) and seq <= seq_mostrada)
+        if not ultimo_estado or (device_id == obtener_device_id(ultimo_estado) and mas_reciente):
+            data['timestamp'] = timestamp
+            publicado = _nueva_vista({'ultimo_estado': data}, ())
+    
+    response = {
+        "status": "throttled",
+        "reason": motivo,
+        "retry_after": reintentar_en,
+        "timestamp": timestamp
+    }
+    # Mismo orden que una muestra admitida: primero el manual, luego el de temporizador
+    comando = tomar_comando_pendiente(timestamp)
+    if comando:
+        response["command"] = comando
+    else:
+        comando_timer = comandos_temporizador.pop(device_id, None)
+        if comando_timer:
+            response["command"] = comando_timer
+            print(f"⏰ Enviando comando de temporizador: {comando_timer}")
+            publicar(entradas=(f"[{timestamp}] ⏰ AUTO (temporizador): {comando_timer}",))
+    
+    respuesta, codigo = responder_con_tiempos(cronometro, response, 429)
+    respuesta.headers['Retry-After'] = str(reintentar_en)
+    return respuesta, codigo
+
+
 @app.route('/api/traffic', methods=['POST'])
 def recibir_datos():
     """Endpoint que recibe datos del ESP32"""
-    global ultimo_estado, comando_pendiente
-    
+    cronometro = iniciar_cronometro()
     try:
         data = request.get_json()
+        marcar_etapa(cronometro, 'json')
         
         if data:
-            # Agregar timestamp
-            data['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            ultimo_estado = data
+            device_id = obtener_device_id(data)
+            seq = data.get('seq')
+            con_secuencia = isinstance(seq, int) and not isinstance(seq, bool)
+            
+            # Un reintento ya procesado se responde desde la caché sin gastar cupo de admisión
+            boot_id = data.get('boot_id')
+            clasificacion = ver_secuencia(device_id, seq, boot_id) if con_secuencia else 'nuevo'
+            if clasificacion in ('duplicado', 'antiguo'):
+                return responder_repetida(cronometro, device_id, seq, clasificacion)
+            
+            # Control de admisión: bajo sobrecarga se descarta la telemetría
+            # pero los comandos pendientes se siguen entregando
+            motivo, reintentar_en = admitir_muestra(device_id)
+            marcar_etapa(cronometro, 'admision')
+            if motivo:
+                return responder_descartada(cronometro, data, device_id, motivo, reintentar_en, clasificacion)
+            g.muestra_admitida = True
+            
+            # Registrar la secuencia (otra petición pudo registrarla mientras tanto)
+            if con_secuencia:
+                clasificacion = clasificar_secuencia(device_id, seq, boot_id)
+                if clasificacion in ('duplicado', 'antiguo'):
+                    return responder_repetida(cronometro, device_id, seq, clasificacion)
+            
+            # Agregar timestamp (del dispositivo si es confiable)
+            data['timestamp'] = timestamp_muestra(data)
+            data['tardio'] = clasificacion == 'tardio'
+            if data['tardio']:
+                print(f"🔀 Muestra fuera de orden: {device_id} seq={seq}")
+            marcar_etapa(cronometro, 'dedup')
+            
+            # Detectar anomalías en sensores antes de alimentar las ventanas
+            data['anomalias'] = detectar_anomalias(data)
+            publicar_anomalias(device_id)
+            marcar_etapa(cronometro, 'anomalias')
             
             # Guardar en CSV (persistente)
             guardar_en_csv(data)
+            marcar_etapa(cronometro, 'csv')
             
-            # Agregar a datos de análisis (tiempo real)
-            agregar_dato_analisis(data)
+            # Agregar a datos de análisis (tiempo real), solo muestras válidas
+            if not data['anomalias']:
+                with lock_cerebro:
+                    agregar_dato_analisis(data)
+            marcar_etapa(cronometro, 'analisis')
             
             # === MODO AUTOMÁTICO: Analizar y decidir ===
             comando_auto, razon = analizar_y_decidir(data)
+            marcar_etapa(cronometro, 'decision')
+            entradas = []
             if comando_auto:
                 print(f"🤖 Decisión automática: {comando_auto} - {razon}")
-                historial.append(f"[{data['timestamp']}] 🤖 AUTO: {comando_auto} ({razon})")
+                entradas.append(f"[{data['timestamp']}] 🤖 AUTO: {comando_auto} ({razon})")
             
             # Guardar en historial (memoria)
             log_entry = f"[{data['timestamp']}] Estado: {data.get('estado')} | D1: {data.get('vehiculos_dir1')} | D2: {data.get('vehiculos_dir2')} | CO2: {data.get('co2')}"
-            historial.append(log_entry)
+            entradas.append(log_entry)
             
-            # Limitar historial a 100 entradas
-            if len(historial) > 100:
-                historial.pop(0)
+            # Publicar muestra, historial y cerebro juntos (la muestra ya no se modifica).
+            # La copia y la publicación van en la misma sección crítica que las
+            # modificaciones: una vista más vieja nunca reemplaza a una más nueva
+            with lock_cerebro:
+                cambios = {'cerebro': vista_cerebro(), 'datos_analisis': tuple(datos_analisis)}
+                if not data['tardio']:
+                    cambios['ultimo_estado'] = data
+                publicar(cambios, entradas)
             
             print(f"📨 Recibido: {json.dumps(data, indent=2)}")
+            marcar_etapa(cronometro, 'log')
             
             # Respuesta al ESP32 con comando si hay uno pendiente
             response = {
@@ -782,48 +1560,171 @@ def recibir_datos():
                 "timestamp": data['timestamp']
             }
             
-            # Si hay comando pendiente, enviarlo
-            if comando_pendiente:
-                response["command"] = comando_pendiente
-                print(f"📤 Enviando comando manual: {comando_pendiente}")
-                historial.append(f"[{data['timestamp']}] 📤 COMANDO ENVIADO: {comando_pendiente}")
-                comando_pendiente = None  # Limpiar después de enviar
+            # Si hay comando pendiente, enviarlo (se saca y limpia en un solo paso)
+            comando_manual = tomar_comando_pendiente(data['timestamp'])
+            if comando_manual:
+                response["command"] = comando_manual
+                print(f"📤 Enviando comando manual: {comando_manual}")
             # Si hay comando automático, enviarlo
             elif comando_auto:
                 response["command"] = comando_auto
                 print(f"🤖 Enviando comando automático: {comando_auto}")
+            # Si un temporizador decidió un ajuste mientras no llegaban muestras
+            else:
+                comando_timer = comandos_temporizador.pop(device_id, None)
+                if comando_timer:
+                    response["command"] = comando_timer
+                    print(f"⏰ Enviando comando de temporizador: {comando_timer}")
+                    publicar(entradas=(f"[{data['timestamp']}] ⏰ AUTO (temporizador): {comando_timer}",))
             
-            return jsonify(response), 200
+            # Guardar la respuesta para responder igual a un reintento
+            if con_secuencia:
+                with lock_secuencias:
+                    secuencias_dispositivos[device_id]['ultima_respuesta'] = {'seq': seq, 'respuesta': response}
+            marcar_etapa(cronometro, 'respuesta')
+            
+            return responder_con_tiempos(cronometro, response, 200)
         else:
-            return jsonify({"status": "error", "message": "No data received"}), 400
+            return responder_con_tiempos(cronometro, {"status": "error", "message": "No data received"}, 400)
             
     except Exception as e:
         print(f"❌ Error: {str(e)}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        # Las peticiones fallidas también cuentan en /api/timings y Server-Timing
+        marcar_etapa(cronometro, 'error')
+        return responder_con_tiempos(cronometro, {"status": "error", "message": str(e)}, 500)
 
 
 @app.route('/api/status', methods=['GET'])
 def obtener_estado():
     """Endpoint para obtener el estado actual (para otras aplicaciones)"""
-    return jsonify(ultimo_estado), 200
+    return jsonify(publicado['ultimo_estado']), 200
 
 
 @app.route('/api/history', methods=['GET'])
 def obtener_historial():
     """Endpoint para obtener el historial"""
-    return jsonify({"historial": historial[-50:]}), 200
+    return jsonify({"historial": list(publicado['historial'][-50:])}), 200
+
+
+@app.route('/api/anomalias', methods=['GET'])
+def obtener_anomalias():
+    """Endpoint con las anomalías recientes y el estado de los detectores"""
+    vista = publicado
+    return jsonify({
+        "anomalias": list(vista['anomalias']),
+        "detectores": vista['detectores']
+    }), 200
+
+
+@app.route('/api/timings', methods=['GET'])
+def obtener_tiempos():
+    """Endpoint con los tiempos acumulados por etapa de /api/traffic"""
+    return jsonify({"etapas": resumen_tiempos()}), 200
+
+
+@app.route('/api/decisions', methods=['GET'])
+def obtener_decisiones():
+    """
+    Consulta la bitácora de decisiones. Filtros opcionales: device, param
+    (SP_PEATONAL, SP_VERDE_PESADO_MAX), regla, direccion (subida/bajada),
+    desde/hasta (ISO 8601) y limite (default 100, máximo MAX_LIMITE_DECISIONES).
+    """
+    try:
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        direccion = request.args.get('direccion')
+        if direccion not in (None, 'subida', 'bajada'):
+            raise ValueError("direccion debe ser 'subida' o 'bajada'")
+        limite = int(request.args.get('limite', 100))
+        if limite < 1:
+            raise ValueError("limite debe ser mayor o igual a 1")
+        limite = min(limite, MAX_LIMITE_DECISIONES)
+        decisiones = consultar(
+            bitacora,
+            dispositivo=request.args.get('device'),
+            parametro=request.args.get('param'),
+            regla=request.args.get('regla'),
+            direccion=direccion,
+            desde_ms=datetime.fromisoformat(desde).timestamp() * 1000 if desde else None,
+            hasta_ms=datetime.fromisoformat(hasta).timestamp() * 1000 if hasta else None,
+            limite=limite
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    for d in decisiones:
+        d['timestamp'] = datetime.fromtimestamp(d['timestamp_ms'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+    versiones = sorted({d['version_config'] for d in decisiones})
+    return jsonify({
+        "decisiones": decisiones,
+        "configs": {str(v): obtener_config(bitacora, v) for v in versiones},
+        "bitacora": resumen_bitacora(bitacora)
+    }), 200
+
+
+@app.route('/api/timers', methods=['GET'])
+def obtener_temporizadores():
+    """Endpoint con el estado de la rueda de temporizadores"""
+    return jsonify(resumen_temporizadores()), 200
+
+
+@app.route('/api/admission', methods=['GET'])
+def obtener_admision():
+    """Endpoint con las estadísticas del control de admisión"""
+    return jsonify(resumen_admision()), 200
+
+
+@app.route('/api/admin/profile/start', methods=['POST'])
+def iniciar_perfil():
+    """Inicia el perfilador por muestreo durante N segundos (?segundos=N)"""
+    if not es_peticion_local():
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    
+    try:
+        segundos = float(request.values.get('segundos', 30))
+    except ValueError:
+        return jsonify({"status": "error", "message": "segundos inválido"}), 400
+    segundos = max(1.0, min(segundos, CONFIG_PERFILADO['max_segundos_perfil']))
+    
+    if not iniciar_perfilado(segundos):
+        return jsonify({"status": "error", "message": "perfilado en curso", "perfil": estado_perfilado()}), 409
+    return jsonify({"status": "ok", "segundos": segundos, "perfil": estado_perfilado()}), 200
+
+
+@app.route('/api/admin/profile/stop', methods=['POST'])
+def detener_perfil():
+    """Detiene el perfilador antes de tiempo"""
+    if not es_peticion_local():
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    
+    detener_perfilado()
+    return jsonify({"status": "ok", "perfil": estado_perfilado()}), 200
+
+
+@app.route('/api/admin/profile', methods=['GET'])
+def descargar_perfil():
+    """Descarga el resultado en formato 'collapsed stacks' (compatible con flamegraph)"""
+    if not es_peticion_local():
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    
+    if request.args.get('formato') == 'json':
+        return jsonify(estado_perfilado()), 200
+    
+    contenido = "\n".join(f"{pila} {n}" for pila, n in pilas_perfilado())
+    return contenido + "\n", 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Disposition': 'attachment; filename=perfil_servidor.txt'
+    }
 
 
 @app.route('/api/command', methods=['POST'])
 def enviar_comando():
     """Endpoint para enviar comandos al ESP32 desde el dashboard"""
-    global comando_pendiente
-    
     cmd = request.form.get('cmd')
     if cmd:
-        comando_pendiente = cmd
+        publicar({'comando_pendiente': cmd},
+                 (f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 🎮 COMANDO PROGRAMADO: {cmd}",))
         print(f"🎮 Comando programado: {cmd}")
-        historial.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 🎮 COMANDO PROGRAMADO: {cmd}")
     
     # Redirigir de vuelta al dashboard
     from flask import redirect
@@ -833,14 +1734,19 @@ def enviar_comando():
 @app.route('/api/auto', methods=['POST'])
 def toggle_automatico():
     """Endpoint para activar/desactivar el modo automático"""
-    global modo_automatico, ultimo_comando_auto
-    
-    modo_automatico = not modo_automatico
-    ultimo_comando_auto = None  # Resetear último comando
+    global modo_automatico, ultimo_comando_auto, publicado
     
-    estado = "ACTIVADO" if modo_automatico else "DESACTIVADO"
+    # Dos clics simultáneos no deben perder un cambio
+    with lock_publicacion:
+        modo_automatico = not modo_automatico
+        ultimo_comando_auto = None  # Resetear último comando
+        if not modo_automatico:
+            comandos_temporizador.clear()
+        
+        estado = "ACTIVADO" if modo_automatico else "DESACTIVADO"
+        publicado = _nueva_vista({'modo_automatico': modo_automatico},
+                                 (f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 🤖 MODO AUTOMÁTICO: {estado}",))
     print(f"🤖 Modo automático: {estado}")
-    historial.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 🤖 MODO AUTOMÁTICO: {estado}")
     
     from flask import redirect
     return redirect('/')
@@ -854,6 +1760,10 @@ if __name__ == '__main__':
     # Inicializar archivo CSV
     inicializar_csv()
     
+    # Bitácora de decisiones durable (reconstruye los índices al abrir)
+    bitacora = abrir_bitacora(DIRECTORIO_BITACORA)
+    print(f"📒 Bitácora de decisiones: {DIRECTORIO_BITACORA}/ ({bitacora['n']} decisiones)")
+    
     print("📡 Iniciando servidor en http://0.0.0.0:5000")
     print("📱 Interfaz web: http://localhost:5000")
     print("📨 API endpoint: http://localhost:5000/api/traffic")
@@ -862,4 +1772,7 @@ if __name__ == '__main__':
     print("⚠️  Asegúrate de configurar la IP de este servidor en el ESP32")
     print("=" * 60)
     
+    # Evaluación por temporizadores (cooldowns y ventanas que expiran)
+    iniciar_temporizadores()
+    
     app.run(host='0.0.0.0', port=5000, debug=True)